@@ -0,0 +1,85 @@
+# Archive time and size on a mixed invoice corpus: every entry deflated (shutil.make_archive) against the
+# per entry policy of addFileEntry (STORED_EXTENSIONS stored, the rest deflated at ARCHIVE_DEFLATE_LEVEL)
+# Usage: python benchmarks/bench_archive_compression.py [files]
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from invoice_common import addFileEntry
+
+# Share of the corpus and size range in KB per type, most invoices are PDFs
+CORPUS_MIX = [
+    (".pdf", 0.70, (80, 600)),
+    (".jpg", 0.10, (150, 900)),
+    (".png", 0.05, (100, 700)),
+    (".zip", 0.05, (200, 1500)),
+    (".html", 0.07, (20, 200)),
+    (".txt", 0.03, (5, 50)),
+]
+
+
+def makeText(size):
+    words = [b"Invoice", b"GSTIN", b"Amount", b"Tax", b"Total", b"IGST", b"CGST", b"SGST", b"<td>", b"</td>"]
+    out = bytearray()
+    while len(out) < size:
+        out += random.choice(words) + b" " + str(random.randint(0, 99999)).encode() + b"\n"
+    return bytes(out[:size])
+
+
+def makeFile(extension, size):
+    if extension in (".html", ".txt"):
+        return makeText(size)
+    if extension == ".pdf":
+        # Mostly FlateDecode streams that are already compressed, with some plain PDF structure around them
+        return b"%PDF-1.4\n" + makeText(size // 20) + os.urandom(size - size // 20)
+    return os.urandom(size)
+
+
+def makeCorpus(folder, files):
+    for i in range(files):
+        roll = random.random()
+        for extension, share, (low, high) in CORPUS_MIX:
+            roll -= share
+            if roll <= 0:
+                break
+        with open(os.path.join(folder, f"invoice_{i}{extension}"), "wb") as file:
+            file.write(makeFile(extension, random.randint(low, high) * 1024))
+
+
+def deflateAll(folder, out_dir):
+    started = time.perf_counter()
+    archive_path = shutil.make_archive(os.path.join(out_dir, "deflate_all"), "zip", folder)
+    return time.perf_counter() - started, os.path.getsize(archive_path)
+
+
+def perEntryPolicy(folder, out_dir):
+    archive_path = os.path.join(out_dir, "policy.zip")
+    started = time.perf_counter()
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(os.listdir(folder)):
+            addFileEntry(archive, os.path.join(folder, name), name)
+    return time.perf_counter() - started, os.path.getsize(archive_path)
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    random.seed(17)
+    with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as out_dir:
+        makeCorpus(folder, files)
+        corpus_size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+        deflate_time, deflate_size = deflateAll(folder, out_dir)
+        policy_time, policy_size = perEntryPolicy(folder, out_dir)
+    print(f"corpus: {files} files, {corpus_size / 1024 / 1024:.1f} MB")
+    print(f"{'archive':<12} {'seconds':>8} {'size MB':>8}")
+    print(f"{'deflate all':<12} {deflate_time:>8.2f} {deflate_size / 1024 / 1024:>8.1f}")
+    print(f"{'per entry':<12} {policy_time:>8.2f} {policy_size / 1024 / 1024:>8.1f}")
+    print(f"time {policy_time / deflate_time:.0%} of deflate all, size {policy_size / deflate_size - 1:+.1%}")
+
+
+if __name__ == "__main__":
+    main()
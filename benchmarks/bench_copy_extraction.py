@@ -0,0 +1,90 @@
+# Cursor against COPY TO STDOUT extraction (fetchRecordBatches) on a local Postgres fixture
+# Usage: python benchmarks/bench_copy_extraction.py [rows ...]
+# BENCH_PG_URL points at a scratch database, without it a throwaway server is started through pgserver
+import os
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+from script_loader import loadScript
+
+report = loadScript("send-report.py")
+
+TABLE_NAME = "recon_report_bench"
+COLUMN_QUERY = ('"Workspace", "Invoice No", "Amount", "Quantity", "Is Matched", "Invoice Date", "Updated At", '
+                '"Vendor"')
+COLUMN_TYPES = {
+    "Workspace": "text",
+    "Invoice No": "text",
+    "Amount": "number",
+    "Quantity": "number",
+    "Is Matched": "text",
+    "Invoice Date": "date",
+    "Updated At": "date",
+    "Vendor": "text",
+}
+
+
+def getDatabaseUrl():
+    if os.getenv("BENCH_PG_URL"):
+        return os.getenv("BENCH_PG_URL")
+    import pgserver
+    server = pgserver.get_server(tempfile.mkdtemp(prefix="bench_pg_"), cleanup_mode="stop")
+    return server.get_uri()
+
+
+def createFixture(conn, rows):
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
+        cursor.execute(f"""
+            CREATE TABLE {TABLE_NAME} AS
+            SELECT 'Workspace ' || (i %% 20) AS "Workspace",
+                   lpad((i %% 100000)::text, 8, '0') AS "Invoice No",
+                   round((random() * 100000)::numeric, 2) AS "Amount",
+                   (i %% 50)::int AS "Quantity",
+                   (i %% 3 = 0) AS "Is Matched",
+                   DATE '2023-01-01' + (i %% 700) AS "Invoice Date",
+                   TIMESTAMP '2023-01-01' + (i || ' minutes')::interval AS "Updated At",
+                   'Vendor ' || (i %% 500) AS "Vendor"
+            FROM generate_series(1, %s) AS i""", (rows,))
+        cursor.execute(f"ANALYZE {TABLE_NAME}")
+    conn.commit()
+
+
+def extract(backend):
+    report.EXTRACT_BACKEND = backend
+    started = time.perf_counter()
+    record_count = 0
+    first_batch = None
+    for batch in report.fetchRecordBatches(TABLE_NAME, ["admin"], COLUMN_QUERY, COLUMN_TYPES):
+        if first_batch is None:
+            first_batch = batch
+        record_count += len(batch)
+    report.pgconn.rollback()
+    return time.perf_counter() - started, record_count, first_batch
+
+
+def main():
+    row_counts = [int(arg) for arg in sys.argv[1:]] or [10000, 50000, 200000, 500000]
+    database_url = getDatabaseUrl()
+    report.connectPostgres = lambda: psycopg2.connect(database_url)
+    report.pgconn = psycopg2.connect(database_url)
+    report.EXTRACT_PARTITIONS = 1
+
+    print(f"{'rows':>8} {'cursor s':>9} {'copy s':>7} {'speedup':>8}")
+    for rows in row_counts:
+        createFixture(report.pgconn, rows)
+        cursor_time, cursor_count, cursor_batch = extract("cursor")
+        copy_time, copy_count, copy_batch = extract("copy")
+        if cursor_count != copy_count:
+            print(f"{rows}: cursor read {cursor_count} rows, copy read {copy_count}")
+        for col in cursor_batch.columns:
+            if cursor_batch[col].dtype != copy_batch[col].dtype:
+                print(f"{rows}: {col} is {cursor_batch[col].dtype} from the cursor, {copy_batch[col].dtype} from copy")
+        print(f"{rows:>8} {cursor_time:>9.2f} {copy_time:>7.2f} {cursor_time / copy_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
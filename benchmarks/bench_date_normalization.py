@@ -0,0 +1,68 @@
+# Per column date detection (normalizeDateColumn) against the per cell try_convert_to_date loop
+# Usage: python benchmarks/bench_date_normalization.py [rows]
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from script_loader import loadScript
+
+report = loadScript("send-report.py")
+
+COLUMN_FORMATS = ["%Y-%m-%d", "%d/%m/%Y", "%Y-%m-%d %H:%M:%S", "%d-%b-%Y"]
+
+
+def makeColumn(rows, fmt):
+    start = datetime(2020, 1, 1)
+    values = [(start + timedelta(days=random.randint(0, 1500), seconds=random.randint(0, 86399))).strftime(fmt)
+              for _ in range(rows)]
+    # A few blanks and values in another format, like the exports carry
+    for i in random.sample(range(rows), rows // 100):
+        values[i] = None
+    for i in random.sample(range(rows), rows // 200):
+        values[i] = start.strftime("%d-%m-%Y")
+    return pd.Series(values, dtype=object)
+
+
+def cellLoop(series):
+    # The xlsxWriter loop before the per column detection
+    values = []
+    styles = []
+    for value in series.tolist():
+        if value is None:
+            values.append(None)
+            styles.append(None)
+            continue
+        date_value, format_used = report.try_convert_to_date(value)
+        if date_value:
+            values.append(date_value)
+            styles.append("datetime" if "%H:%M" in format_used else "date")
+        else:
+            values.append(value)
+            styles.append(None)
+    return values, styles
+
+
+def timeIt(func, series):
+    started = time.perf_counter()
+    result = func(series)
+    return time.perf_counter() - started, result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(7)
+    print(f"{'format':<20} {'rows':>8} {'cell loop s':>12} {'per column s':>13} {'speedup':>8}")
+    for fmt in COLUMN_FORMATS:
+        series = makeColumn(rows, fmt)
+        loop_time, (loop_values, loop_styles) = timeIt(cellLoop, series)
+        column_time, (column_values, column_styles, _) = timeIt(report.normalizeDateColumn, series)
+        if loop_values != column_values or loop_styles != column_styles:
+            print(f"{fmt}: per column result differs from the cell loop")
+        print(f"{fmt:<20} {rows:>8} {loop_time:>12.3f} {column_time:>13.3f} {loop_time / column_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
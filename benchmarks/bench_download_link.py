@@ -0,0 +1,71 @@
+# extractDownloadLink against the BeautifulSoup lookup it replaced, on invoice pages of 5-20 MB
+# Usage: python benchmarks/bench_download_link.py [page MB ...]
+import base64
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from invoice_common import extractDownloadLink
+
+PAGE_HEAD = b"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8"><title>Invoice</title>
+<link rel="stylesheet" href="/static/css/invoice.css">
+<script src="/static/js/jquery.min.js"></script>
+</head>
+<body>
+<div class="header"><img src="/static/img/logo.png" alt="logo"><h1>Tax Invoice</h1></div>
+<table class="details">""" + b"".join(b'<tr><td class="label">Field %d</td><td>Value %d</td></tr>' % (i, i)
+                                    for i in range(200)) + b"""</table>
+<div class="download"><a class="btn btn-primary" id="downloadLink" download="invoice.pdf" href="data:application/pdf;base64,"""
+PAGE_TAIL = b"""">Download</a></div>
+<script>document.getElementById("downloadLink").click();</script>
+</body>
+</html>
+"""
+
+
+def makePage(size_mb):
+    # Payload sized so the whole page is about size_mb, base64 grows the bytes by 4/3
+    payload = os.urandom(int(size_mb * 1024 * 1024 * 3 / 4))
+    return PAGE_HEAD + base64.b64encode(payload) + PAGE_TAIL
+
+
+def parseWithSoup(content):
+    # fetch_base64_from_page before the fast path, response.text included
+    soup = BeautifulSoup(content.decode('utf-8'), 'html.parser')
+    anchor = soup.find('a', id='downloadLink')
+    if anchor and 'href' in anchor.attrs:
+        return anchor['href']
+    return None
+
+
+def timeIt(func, content, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(content)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    sizes = [float(arg) for arg in sys.argv[1:]] or [5, 10, 20]
+    print(f"{'page MB':>8} {'soup s':>8} {'extract s':>10} {'speedup':>9}")
+    for size_mb in sizes:
+        content = makePage(size_mb)
+        soup_time, soup_href = timeIt(parseWithSoup, content, 1)
+        extract_time, extract_href = timeIt(extractDownloadLink, content, 5)
+        if soup_href != extract_href:
+            print(f"{size_mb}: extractDownloadLink returned a different href")
+        print(f"{len(content) / 1024 / 1024:>8.1f} {soup_time:>8.3f} {extract_time:>10.4f} {soup_time / extract_time:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import importlib.util
+import os
+import sys
+from unittest import mock
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadScript(filename):
+    # The report scripts connect to Postgres and Mongo at import, both are stubbed so their pure helpers can run here
+    name = os.path.splitext(filename)[0].replace("-", "_")
+    if name in sys.modules:
+        return sys.modules[name]
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    with mock.patch("psycopg2.connect"), mock.patch("pymongo.MongoClient"):
+        spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return module
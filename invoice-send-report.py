@@ -1,20 +1,21 @@
 import time
-from tendo import singleton
 import psycopg2
+from psycopg2 import sql
 import os
 from dotenv import load_dotenv
 load_dotenv()
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from pymongo import MongoClient
-import boto3
 from sendgrid.helpers.mail import Mail
 import pytz
-import base64
 import requests
-from bs4 import BeautifulSoup
 import shutil
-import hashlib
+import zipfile
+from pg_query import getTableIdentifier, executePrepared
+from job_lease import LeaseLost, getJobTimes, runLeasedJob, runWorker, acquireHostSlot
+from invoice_common import S3MultipartWriter, addFolderEntry, downloadFile, finishDownloads, download_stats, \
+    download_index, resetDownloadStats, resetDownloadIndex, loadCheckpoints, clearCheckpoints, evictBlobCache
 
 
 ist = pytz.timezone('Asia/Kolkata')
@@ -44,15 +45,12 @@ postgres_user = os.getenv("PG_USER")
 postgres_password = os.getenv("PG_PASSWORD")
 postgres_port = os.getenv("PG_PORT")
 
-aws_access_key_id = os.getenv('AWS_ACCESS')
-aws_secret_access_key = os.getenv('AWS_SECRET')
-bucket_name = os.getenv('DEST_AWS_BUCKET_NAME')
-
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY')
 
 MONGO_URL = os.getenv('MONGO_URL')
 client = MongoClient(MONGO_URL, maxIdleTimeMS=None)
 logging.info("Mongo connection successful")
+collection = client['gstservice']['invoice_report']
 
 pgconn = psycopg2.connect(
     host=postgres_host,
@@ -62,7 +60,11 @@ pgconn = psycopg2.connect(
     password=postgres_password
 )
 
-LIMIT = 1
+# Jobs run at the same time by this worker, each in its own process
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 1))
+
+# Rows pulled per round trip by the invoice link scan, also the most links handed to downloadFile at once
+PG_ITERSIZE = int(os.getenv("PG_ITERSIZE", 5000))
 
 currtime = int(time.time())
 bucket_time = int(currtime / (90 * 24 * 60 * 60))
@@ -99,242 +101,104 @@ def sendMailToClient(to_emails, template_id, dynamic_template_data):
             logging.info(f"Error sending email to {to_email}: {e}")
 
 
-def deleteFolder(folder_path):
-    logging.info("deleteFolder called...")
-    if os.path.exists(folder_path):
-        shutil.rmtree(folder_path)
-        logging.info(f"Folder '{folder_path}' deleted successfully.")
-    else:
-        logging.info(f"Folder '{folder_path}' does not exist.")
-
-
-def uploadFile(filepath):
-    try:
-        logging.info("uploadFile called...")
-        filename = filepath.split("/")[-1]
-        s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id,
-                          aws_secret_access_key=aws_secret_access_key)
-        object = f"{bucket_time}/{filename}"
-        s3_url = f"https://{bucket_name}.s3.amazonaws.com/{object}"
-        s3.upload_file(filepath,
-                       bucket_name,
-                       Key=object
-                       )
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        return s3_url
-    except Exception as e:
-        logging.info("Exception happened in the getS3Url: " + str(e))
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        return None
-
-
-def findFileHash(file_path, hash_algo='sha256'):
-    hash_func = hashlib.new(hash_algo)
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_func.update(chunk)
-    return hash_func.hexdigest()
-
-
-def zipHandler(local_file_path):
-    try:
-        logging.info("zipHandler called...")
-        shutil.make_archive(local_file_path, 'zip', local_file_path)
-        filehash = findFileHash(local_file_path + ".zip")
-        s3_link = uploadFile(local_file_path + ".zip")
-        deleteFolder(local_file_path)
-        return s3_link, filehash
-    except Exception as e:
-        logging.info("Exception happened in zipHandler: " + str(e))
-        return None
-
-
-def fetch_base64_from_page(url):
-    element_id = 'downloadLink'
-    # Fetch the HTML content from the URL
-    response = requests.get(url)
-    response.raise_for_status()
-
-    # Parse the HTML content
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    # Find the <a> tag with the specified ID and get the href attribute
-    anchor = soup.find('a', id=element_id)
-    if anchor and 'href' in anchor.attrs:
-        return anchor['href']
-    else:
-        return None
-
-
-def download_base64_file(base64_string, file_path):
-    logging.info("Downloading the file: " + str(file_path))
-    # Extract the MIME type and base64 data from the input string
-    mime_info, base64_data = base64_string.split(',', 1)
-
-    # Decode base64 to binary data
-    binary_data = base64.b64decode(base64_data)
-
-    # Save the binary data to a file
-    with open(file_path, 'wb') as file:
-        file.write(binary_data)
+def getArchiveName(url, filePathArr, blobPath):
+    filehash = url.split("/")[-1]
+    filename = ""
+    filepath = ""
+    for j in range(len(filePathArr)):
+        filename += filePathArr[j].replace(" ", "_")
+        filepath += filePathArr[j]
+        if j < len(filePathArr):
+            filename += "_"
+            filepath += "/"
+    filename += filehash
+    return f"{filepath}{filename}" + os.path.splitext(blobPath)[1]
 
 
-def downloadFile(baseFolderName, invoiceLinks, filePathArr):
-    try:
-        logging.info("downloadFile called...")
-        logging.info("No. of file to download: " + str(len(invoiceLinks)))
-        for i in range(len(invoiceLinks)):
-            url = invoiceLinks[i][0]
-            base64_string = fetch_base64_from_page(url)
-            mime_type = base64_string.split(';')[0].split(':')[1]
-            mime_to_extension = {
-                'application/pdf': '.pdf',
-                'image/png': '.png',
-                'image/jpeg': '.jpg',
-                'text/plain': '.txt',
-                'text/html':'.html',
-                'application/zip': '.zip',
-            }
-            # file_extension = mime_to_extension.get(mime_type, '.bin')
-            file_extension = mime_to_extension.get(mime_type, '.pdf')
-            filehash = url.split("/")[-1]
-            filename = ""
-            filepath = baseFolderName + "/"
-            for j in range(len(filePathArr)):
-                filename += filePathArr[j].replace(" ", "_")
-                filepath += filePathArr[j]
-                if j < len(filePathArr):
-                    filename += "_"
-                    filepath += "/"
-            filename += filehash
-            file_path_with_filename = f"{filepath}{filename}{file_extension}"
-            download_base64_file(base64_string, file_path_with_filename)
-
-    except Exception as e:
-        logging.info("Exception happened in downloadFile: " + str(e))
-
-
-def getInvoicesDetails(baseFolderName, folderDetails, columnLinks, conditionalColumn, tableName, workspaces):
+def getInvoicesDetails(lease, baseFolderName, columnLinks, conditionalColumn, tableName, workspaces):
+    archive_writer = None
     try:
         logging.info("getInvoicesDetails called...")
-        totalfiles = 0
-        workspaceCondtion = ""
-        for i in range(len(workspaces)):
-            workspaceCondtion += '"Workspace"' + " ILIKE " + "'%" + workspaces[i] + "%'"
-            if i < len(workspaces) - 1:
-                workspaceCondtion += " OR "
-
-        for i in range(len(columnLinks)):
-            linkColumn = columnLinks[i]
-            if len(folderDetails)!=0:
-                for j in range(len(folderDetails)):
-                    columnCondition = ""
-                    filePathArr = []
-                    for k in range(len(folderDetails[j])):
-                        columnCondition += '"' + conditionalColumn[k]["field"] + '"' + "='" + folderDetails[j][k] + "'"
-                        filePathArr.append(folderDetails[j][k])
-                        if k < len(folderDetails[j]) - 1:
-                            columnCondition += " AND "
-
-                    with pgconn.cursor() as cursor:
-                        select_query = f'SELECT "{linkColumn}" FROM {tableName} WHERE  {workspaceCondtion} AND "{linkColumn}" IS NOT NULL AND {columnCondition}'
-                        logging.info("Query: " + str(select_query))
-                        cursor.execute(select_query)
-                        results = cursor.fetchall()
-                        totalfiles += len(results)
-                        downloadFile(baseFolderName, results, filePathArr)
-            else:
-                with pgconn.cursor() as cursor:
-                    select_query = f'SELECT "{linkColumn}" FROM {tableName} WHERE  {workspaceCondtion} AND "{linkColumn}" IS NOT NULL'
-                    logging.info("Query: " + str(select_query))
-                    cursor.execute(select_query)
-                    results = cursor.fetchall()
-                    totalfiles += len(results)
-                    filePathArr=[]
-                    downloadFile(baseFolderName, results, filePathArr)
-
-        s3_link, filehash = zipHandler(baseFolderName)
-        return s3_link, filehash, totalfiles
+        totalentries = 0
+        workspacePatterns = ["%" + workspaces[i] + "%" for i in range(len(workspaces))]
+
+        groupColumns = [conditionalColumn[k]["field"] for k in range(len(conditionalColumn))]
+        columns = sql.SQL(", ").join(sql.Identifier(column) for column in groupColumns + columnLinks)
+        select_query = sql.SQL('SELECT {} FROM {} WHERE "Workspace" ILIKE ANY(%s)').format(
+            columns, getTableIdentifier(tableName))
+        if len(groupColumns) != 0:
+            select_query += sql.SQL(" ORDER BY ") + sql.SQL(", ").join(
+                sql.Identifier(column) for column in groupColumns)
+
+        filename = baseFolderName.split("/")[-1] + ".zip"
+        archive_writer = S3MultipartWriter(f"{bucket_time}/{filename}")
+        update = {
+            "$set": {
+                "uploadkey": archive_writer.object,
+                "uploadid": archive_writer.upload_id
+            }
+        }
+        lease.update(update)
+        with zipfile.ZipFile(archive_writer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            # One scan per job ordered by the grouping columns, so the rows of a folder arrive together
+            # and are split into folders here as they stream in
+            with pgconn.cursor(name="invoice_report_" + str(currtime)) as cursor:
+                cursor.itersize = PG_ITERSIZE
+                logging.info("Query: " + select_query.as_string(pgconn))
+                cursor.execute(select_query, (workspacePatterns,))
+                groupKey = None
+                filePathArr = []
+                invoiceLinks = []
+                for row in cursor:
+                    rowKey = row[:len(groupColumns)]
+                    if rowKey != groupKey or len(invoiceLinks) >= PG_ITERSIZE:
+                        if len(invoiceLinks) != 0:
+                            totalentries += len(invoiceLinks)
+                            downloadFile(lease, archive, invoiceLinks, filePathArr, getArchiveName)
+                            invoiceLinks = []
+                        if rowKey != groupKey:
+                            groupKey = rowKey
+                            filePathArr = [str(value) for value in rowKey]
+                            addFolderEntry(archive, "/".join(filePathArr))
+                    for link in row[len(groupColumns):]:
+                        if link is not None:
+                            invoiceLinks.append(link)
+                if len(invoiceLinks) != 0:
+                    totalentries += len(invoiceLinks)
+                    downloadFile(lease, archive, invoiceLinks, filePathArr, getArchiveName)
+            # Downloads of the last folders may still be running
+            finishDownloads(lease, archive)
+
+        # Only the owner of the job completes the upload, the object in S3 is overwritten with it
+        lease.transition("IN PROGRESS", "FINALIZING")
+        filehash = archive_writer.complete()
+        # totalfiles counts unique invoices, totalentries every link that was archived or attempted
+        return archive_writer.s3_url, filehash, len(download_index), totalentries
+    except LeaseLost:
+        pgconn.rollback()
+        if archive_writer is not None:
+            archive_writer.abort()
+        raise
     except Exception as e:
         logging.info("Exception happened in getInvoicesDetails: " + str(e))
-        return None, None, None
-
-
-def createFolders(data, base_dir='download/invoice_folders_'+str(currtime)):
-    logging.info("createFolders called...")
-    # Create the base directory if it doesn't exist
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir)
-    for entry in data:
-        # The first element is always the airline name
-        parentfolder = entry[0]
-        # All remaining elements are subfolders
-        subfolders = entry[1:]
-
-        # Construct the path recursively by joining airline and subfolders
-        folder_path = os.path.join(base_dir, parentfolder, *subfolders)
-
-        # Create the folders if they don't exist
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-    logging.info(f"Folders created under {base_dir}")
-    return base_dir
-
-
-def getFolderGrouping(columnsDetails, tableName, workspaces):
-    try:
-        logging.info("getFolderGrouping called...")
-        columns = ""
-        for i in range(len(columnsDetails)):
-            columns += '"' + columnsDetails[i]["field"] + '"'
-            if i < len(columnsDetails) - 1:
-                columns += ","
-        workspaceCondtion = ""
-        for i in range(len(workspaces)):
-            workspaceCondtion += '"Workspace"' + " ILIKE " + "'%" + workspaces[i] + "%'"
-            if i < len(workspaces) - 1:
-                workspaceCondtion += " OR "
-        results =[]
-        with pgconn.cursor() as cursor:
-            select_query = f"SELECT {columns} FROM {tableName} WHERE {workspaceCondtion} GROUP BY ({columns})"
-            logging.info("Query: " + str(select_query))
-            cursor.execute(select_query)
-            results = cursor.fetchall()
-            return results
-    except Exception as e:
-        logging.info("Exception happen in getFolderGrouping:  "+str(e))
-        return []
+        pgconn.rollback()
+        if archive_writer is not None:
+            archive_writer.abort()
+        return None, None, None, None
 
 
 def getWorkspcaeName(workspace_ids):
     logging.info("getWorkspcaeName called...")
-    workspcae_condtion = "("
-    for i in range(len(workspace_ids)):
-        workspcae_condtion += "'" + workspace_ids[i] + "'"
-        if i < len(workspace_ids) - 1:
-            workspcae_condtion += ", "
-    workspcae_condtion += ")"
-
     with pgconn.cursor() as cursor:
-        select_query = f"SELECT name FROM workspaces WHERE id IN {workspcae_condtion}"
+        select_query = "SELECT name FROM workspaces WHERE id = ANY($1::uuid[])"
         logging.info("Query: " + str(select_query))
-        cursor.execute(select_query)
+        # workspaces.id is a uuid, the ids arrive as text[] and are cast in the query
+        executePrepared(cursor, "invoice_workspace_names", select_query, (list(workspace_ids),), ("text[]",))
         results = cursor.fetchall()
         finalresult = [item[0] for item in results]
         return finalresult
 
 
-def getPendingJob():
-    logging.info("getPendingJob called...")
-    db = client['gstservice']
-    collection = db['invoice_report']
-    # result = list(collection.find({"reportId": "00d4bf77-df93-41be-a0db-70f3f54c847a"}).limit(LIMIT))
-    result = list(collection.find({"status": "PENDING","$ne": "mongodb"}).sort({"createdBy": -1}).limit(LIMIT))
-    return result
-
-
 def removeOldFilesFolder():
     logging.info("removeOldFilesFolder called...")
     folder_path = 'download/'
@@ -363,115 +227,132 @@ def statusUpdater(key_to_check,update):
     else:
         logging.info("No updates for the document: " + str(key_to_check)+" Update: "+str(update))
 
-if __name__ == '__main__':
+
+def processJob(job, jobtime):
+    global currtime, bucket_time
+    currtime, bucket_time = getJobTimes(jobtime)
+    runLeasedJob(collection, job, runJob, failJob=lambda job: clearCheckpoints(collection, job["_id"]),
+                 finishJob=rollbackPgconn)
+
+
+def rollbackPgconn():
+    # The pool process runs its next job on the same pgconn, no transaction may stay open or aborted
     try:
-        me = singleton.SingleInstance()
-        logging.info("======================================================")
-        removeOldFilesFolder()
-        jobs = getPendingJob()
-        db = client['gstservice']
-        collection = db['invoice_report']
-        if jobs is not None and len(jobs) != 0:
-            for i in range(len(jobs)):
-                logging.info("Processing for job: " + str(jobs[i]))
-                key_to_check = {"_id": jobs[i]["_id"]}
-                update={
-                    "$set":
-                             {
-                                 "status": "IN PROGRESS"
-                             }
-                    }
-                statusUpdater(key_to_check, update)
-
-                if len(jobs[i]["workspace_id"])==0:
-                    key_to_check = {"_id": jobs[i]["_id"]}
-                    update={
-                        "$set": {
-                                "status": "No workspace found",
-                            }
-                        }
-                    statusUpdater(key_to_check, update)
-                    continue
-
-                workspcaes = getWorkspcaeName(jobs[i]["workspace_id"])
-                if len(workspcaes)==0:
-                    key_to_check = {"_id": jobs[i]["_id"]}
-                    update={
-                        "$set": {
-                                "status": "No workspace found",
-                            }
-                        }
-                    statusUpdater(key_to_check, update)
-                    continue
-
-                if len(jobs[i]["groupingPayload"]["rowGroupCols"])!=0:
-                    folderDetails = getFolderGrouping(jobs[i]["groupingPayload"]["rowGroupCols"], jobs[i]["tableName"],
-                                                      workspcaes)
-                else:
-                    folderDetails=[]
-
-                baseFolderName = 'download/invoice_folders_'+str(currtime)
-                if "report_name" in jobs[i]:
-                    baseFolderName = 'download/' + str(jobs[i]["report_name"])
-
-                createFolders(folderDetails, baseFolderName)
-
-                s3_url, filehash, totalfiles = getInvoicesDetails(baseFolderName, folderDetails, jobs[i]["columnLinks"],
-                                                                  jobs[i]["groupingPayload"]["rowGroupCols"],
-                                                                  jobs[i]["tableName"], workspcaes)
-
-                logging.info("S3 URL: " + str(s3_url))
-                if s3_url is not None:
-                    subject = ""
-                    if "report_name" in jobs[i]:
-                        subject = subject + str(jobs[i]["report_name"]) + " is ready to download"
-                    else:
-                        subject = "Report ready to download"
-
-                    dynamic_template_data = {
-                        "subject": subject,
-                        "description": "As per your request we have generated this report of your workspace.",
-                        "download_link": "https://files.finkraft.ai/report-" + str(filehash),
+        pgconn.rollback()
+    except Exception as e:
+        logging.info("Exception happened in rollback: " + str(e))
+
+
+def runJob(job, lease):
+    resetDownloadStats()
+    resetDownloadIndex()
+    loadCheckpoints(collection, job)
+
+    if len(job["workspace_id"])==0:
+        key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+        update={
+            "$set": {
+                    "status": "No workspace found",
+                }
+            }
+        statusUpdater(key_to_check, update)
+        return
+
+    workspcaes = getWorkspcaeName(job["workspace_id"])
+    if len(workspcaes)==0:
+        key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+        update={
+            "$set": {
+                    "status": "No workspace found",
+                }
+            }
+        statusUpdater(key_to_check, update)
+        return
+
+    baseFolderName = 'download/invoice_folders_'+str(currtime)
+    if "report_name" in job:
+        baseFolderName = 'download/' + str(job["report_name"])
+
+    s3_url, filehash, totalfiles, totalentries = getInvoicesDetails(lease, baseFolderName,
+                                                                    job["columnLinks"],
+                                                                    job["groupingPayload"]["rowGroupCols"],
+                                                                    job["tableName"], workspcaes)
+
+    logging.info("S3 URL: " + str(s3_url))
+    if s3_url is not None:
+        subject = ""
+        if "report_name" in job:
+            subject = subject + str(job["report_name"]) + " is ready to download"
+        else:
+            subject = "Report ready to download"
+
+        dynamic_template_data = {
+            "subject": subject,
+            "description": "As per your request we have generated this report of your workspace.",
+            "download_link": "https://files.finkraft.ai/report-" + str(filehash),
+        }
+        template_id = "d-a6a5853662824aa7a69e990013cf1faa"
+        to_emails = []
+        if "to_emails" in job:
+            to_emails = job["to_emails"]
+        if len(to_emails) != 0:
+            lease.confirm()
+            sendMailToClient(to_emails, template_id, dynamic_template_data)
+            key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+            update = {
+                    "$set": {
+                        "status": "COMPLETED",
+                        "link": s3_url,
+                        "filehash": filehash,
+                        "totalfiles": totalfiles,
+                        "totalentries": totalentries,
+                        "retriedlinks": download_stats["retried"],
+                        "failedlinks": download_stats["failed"],
+                        "cachehits": download_stats["cachehits"],
+                        "cachemisses": download_stats["cachemisses"]
                     }
-                    template_id = "d-a6a5853662824aa7a69e990013cf1faa"
-                    to_emails = []
-                    if "to_emails" in jobs[i]:
-                        to_emails = jobs[i]["to_emails"]
-                    if len(to_emails) != 0:
-                        sendMailToClient(to_emails, template_id, dynamic_template_data)
-                        key_to_check = {"_id": jobs[i]["_id"]}
-                        update = {
-                                "$set": {
-                                    "status": "COMPLETED",
-                                    "link": s3_url,
-                                    "filehash": filehash,
-                                    "totalfiles": totalfiles
-                                }
-                            }
-                        statusUpdater(key_to_check, update)
-                    else:
-                        key_to_check = {"_id": jobs[i]["_id"]}
-                        update = {
-                                "$set": {
-                                    "status": "COMPLETED MAIL MISSING",
-                                    "link": s3_url,
-                                    "filehash": filehash,
-                                    "totalfiles": totalfiles
-                                }
-                            }
-                        statusUpdater(key_to_check, update)
-                else:
-                    key_to_check = {"_id": jobs[i]["_id"]}
-                    update = {
-                            "$set": {
-                                "status": "FAILED",
-                            }
-                        }
-                    statusUpdater(key_to_check, update)
+                }
+            statusUpdater(key_to_check, update)
         else:
-            logging.info("No pending jobs")
+            key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+            update = {
+                    "$set": {
+                        "status": "COMPLETED MAIL MISSING",
+                        "link": s3_url,
+                        "filehash": filehash,
+                        "totalfiles": totalfiles,
+                        "totalentries": totalentries,
+                        "retriedlinks": download_stats["retried"],
+                        "failedlinks": download_stats["failed"],
+                        "cachehits": download_stats["cachehits"],
+                        "cachemisses": download_stats["cachemisses"]
+                    }
+                }
+            statusUpdater(key_to_check, update)
+    else:
+        key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+        update = {
+                "$set": {
+                    "status": "FAILED",
+                }
+            }
+        statusUpdater(key_to_check, update)
+    # The checkpoints belong to whoever owns the job, a worker that lost it leaves them
+    lease.check()
+    clearCheckpoints(collection, job["_id"])
+
 
-        logging.info("======================================================")
+if __name__ == '__main__':
+    try:
+        host_slot = acquireHostSlot("invoice-report")
+        if host_slot is None:
+            logging.info("MAX_WORKERS_PER_HOST workers already running on this host")
+        else:
+            logging.info("======================================================")
+            removeOldFilesFolder()
+            evictBlobCache(collection)
+            runWorker(collection, {"dbType": {"$ne": "mongodb"}}, processJob, WORKER_CONCURRENCY, afterJob=evictBlobCache)
+            logging.info("======================================================")
 
     except Exception as e:
 
@@ -0,0 +1,597 @@
+import time
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import logging
+import boto3
+import base64
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup
+import zipfile
+import hashlib
+import re
+import threading
+import concurrent.futures
+from urllib.parse import urlparse
+from job_lease import LeaseLost
+
+# Invoice download, blob cache and archive code shared by invoice-send-report.py and invoice-send-report-mongo.py.
+# Importing it opens no connection, the jobs collection is handed in by the caller, during a job through its
+# JobLease so that every write for the job is fenced on the worker that owns it
+
+aws_access_key_id = os.getenv('AWS_ACCESS')
+aws_secret_access_key = os.getenv('AWS_SECRET')
+bucket_name = os.getenv('DEST_AWS_BUCKET_NAME')
+
+# Invoice pages fetched at the same time, overall and against a single host
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 8))
+PER_HOST_CONCURRENCY = int(os.getenv("PER_HOST_CONCURRENCY", 4))
+download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY)
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+
+# Invoice page requests: connect/read timeouts in seconds, retries with exponential backoff
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 120))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", 1))
+
+# Locate <a id="downloadLink" href="..."> in the raw page without building a DOM
+DOWNLOAD_LINK_ID = re.compile(rb'''\sid\s*=\s*["']downloadLink["']''')
+ANCHOR_OPEN = re.compile(rb'<a\s', re.IGNORECASE)
+HREF_ATTRIBUTE = re.compile(rb'''\shref\s*=\s*(["'])''', re.IGNORECASE)
+
+# Streaming decode of the data URL straight to disk, STREAM_DECODE=false reads whole pages instead
+STREAM_DECODE = os.getenv("STREAM_DECODE", "true").lower() == "true"
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_SCAN_TAIL = 4096
+HREF_DATA_URL = re.compile(rb'''\shref\s*=\s*(["'])(data:)''', re.IGNORECASE)
+BASE64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+
+MIME_TO_EXTENSION = {
+    'application/pdf': '.pdf',
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'text/plain': '.txt',
+    'text/html': '.html',
+    'application/zip': '.zip',
+}
+
+# Downloaded invoices kept across runs, keyed by the last URL segment. Lives outside download/ which is
+# wiped every run, least recently used blobs are evicted after every job once it grows past BLOB_CACHE_MAX_BYTES
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", "cache/invoices/")
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", 20 * 1024 * 1024 * 1024))
+BLOB_KEY_PATTERN = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9._-]*')
+# Blobs used this recently are not evicted, a job still running may be about to archive them
+BLOB_IN_USE_SECONDS = int(os.getenv("BLOB_IN_USE_SECONDS", 5 * 60))
+STALE_PART_SECONDS = 60 * 60
+
+# Archive bytes buffered before they go out as one S3 multipart part, S3 needs at least 5 MiB per part
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", 8 * 1024 * 1024))
+
+# PDFs, images and nested zips barely shrink, so they are stored as is. Everything else (txt/html) is
+# deflated at ARCHIVE_DEFLATE_LEVEL
+STORED_EXTENSIONS = {'.pdf', '.png', '.jpg', '.zip'}
+ARCHIVE_DEFLATE_LEVEL = int(os.getenv("ARCHIVE_DEFLATE_LEVEL", 6))
+
+# Per job counters, reset when a job starts
+download_stats = {"retried": 0, "failed": 0, "cachehits": 0, "cachemisses": 0}
+download_stats_lock = threading.Lock()
+
+# Download future per blob key for the current job, only touched from the job thread
+download_index = {}
+
+# Downloads in flight or waiting to be archived, keyed by future with the links to archive from it. downloadFile
+# returns once fewer than DOWNLOAD_WINDOW are pending, so downloads keep running across folders
+DOWNLOAD_WINDOW = int(os.getenv("DOWNLOAD_WINDOW", DOWNLOAD_CONCURRENCY * 4))
+pending_downloads = {}
+failed_entries = 0
+
+# Completed downloads are checkpointed to CHECKPOINT_COLLECTION every CHECKPOINT_INTERVAL files, so a job that
+# was interrupted resumes from the blob cache instead of starting over
+CHECKPOINT_COLLECTION = 'invoice_report_checkpoints'
+CHECKPOINT_INTERVAL = int(os.getenv("CHECKPOINT_INTERVAL", 100))
+checkpointed_blobs = {}
+checkpoint_pending = []
+
+
+class S3MultipartWriter:
+    # Write-only file object for zipfile. The archive bytes are hashed as they are produced and uploaded
+    # to S3 in S3_PART_SIZE parts, so the zip is never staged on local disk
+
+    def __init__(self, object, hash_algo='sha256'):
+        logging.info("S3MultipartWriter called...")
+        self.s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id,
+                               aws_secret_access_key=aws_secret_access_key)
+        self.object = object
+        self.s3_url = f"https://{bucket_name}.s3.amazonaws.com/{self.object}"
+        self.hash_func = hashlib.new(hash_algo)
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = self.s3.create_multipart_upload(Bucket=bucket_name, Key=self.object)["UploadId"]
+
+    def write(self, data):
+        self.hash_func.update(data)
+        self.buffer += data
+        if len(self.buffer) >= S3_PART_SIZE:
+            self.uploadPart()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def uploadPart(self):
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=bucket_name, Key=self.object, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buffer = bytearray()
+
+    def complete(self):
+        # The last part may be smaller than S3_PART_SIZE
+        if len(self.buffer) != 0 or len(self.parts) == 0:
+            self.uploadPart()
+        self.s3.complete_multipart_upload(Bucket=bucket_name, Key=self.object, UploadId=self.upload_id,
+                                          MultipartUpload={"Parts": self.parts})
+        return self.hash_func.hexdigest()
+
+    def abort(self):
+        abortUpload(self.object, self.upload_id)
+
+
+def abortUpload(object, upload_id):
+    try:
+        s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id,
+                          aws_secret_access_key=aws_secret_access_key)
+        s3.abort_multipart_upload(Bucket=bucket_name, Key=object, UploadId=upload_id)
+    except Exception as e:
+        logging.info("Exception happened in abortUpload: " + str(e))
+
+
+def addFolderEntry(archive, folderPath):
+    # Directory entries for the folder and each of its parents, the way shutil.make_archive wrote them
+    parts = [part for part in folderPath.split("/") if part]
+    for j in range(len(parts)):
+        arcname = "/".join(parts[:j + 1]) + "/"
+        if arcname not in archive.NameToInfo:
+            folder_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+            folder_info.external_attr = (0o40775 << 16) | 0x10
+            archive.writestr(folder_info, b"", compress_type=zipfile.ZIP_STORED)
+
+
+def addFileEntry(archive, filePath, arcname):
+    if arcname in archive.NameToInfo:
+        return
+    addFolderEntry(archive, os.path.dirname(arcname))
+    if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+        archive.write(filePath, arcname, compress_type=zipfile.ZIP_STORED)
+    else:
+        archive.write(filePath, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=ARCHIVE_DEFLATE_LEVEL)
+
+
+def createHttpSession():
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True
+    )
+    # One keep-alive connection pool shared by all download threads
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_CONCURRENCY, pool_maxsize=DOWNLOAD_CONCURRENCY,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+http_session = createHttpSession()
+
+
+def resetDownloadIndex():
+    global failed_entries
+    download_index.clear()
+    pending_downloads.clear()
+    failed_entries = 0
+
+
+def loadCheckpoints(collection, job):
+    logging.info("loadCheckpoints called...")
+    checkpointed_blobs.clear()
+    checkpoint_pending.clear()
+    if "uploadid" in job:
+        # The archive is rebuilt from the start, the upload of the interrupted run is dropped
+        abortUpload(job["uploadkey"], job["uploadid"])
+    checkpoints = collection.database[CHECKPOINT_COLLECTION]
+    checkpoints.create_index([("jobId", 1), ("key", 1)], unique=True)
+    for checkpoint in checkpoints.find({"jobId": job["_id"]}, {"_id": 0, "key": 1, "blob": 1}):
+        checkpointed_blobs[checkpoint["key"]] = checkpoint["blob"]
+    logging.info("No. of checkpointed files: " + str(len(checkpointed_blobs)))
+
+
+def checkpointDownload(lease, blobKey, blobPath):
+    if checkpointed_blobs.get(blobKey) == blobPath:
+        return
+    checkpointed_blobs[blobKey] = blobPath
+    checkpoint_pending.append({"jobId": lease.key["_id"], "key": blobKey, "blob": blobPath})
+    if len(checkpoint_pending) >= CHECKPOINT_INTERVAL:
+        flushCheckpoints(lease)
+
+
+def flushCheckpoints(lease):
+    try:
+        if len(checkpoint_pending) == 0:
+            return
+        update = {
+            "$set": {
+                "stagingdir": BLOB_CACHE_DIR
+            },
+            "$inc": {
+                "checkpointedfiles": len(checkpoint_pending)
+            }
+        }
+        # The job document is written first and fenced, a worker that lost the job adds no checkpoints to it
+        lease.update(update)
+        lease.collection.database[CHECKPOINT_COLLECTION].insert_many(list(checkpoint_pending), ordered=False)
+    except LeaseLost:
+        checkpoint_pending.clear()
+        raise
+    except Exception as e:
+        # Losing a checkpoint only means the file is looked up in the blob cache again on resume
+        logging.info("Exception happened in flushCheckpoints: " + str(e))
+    checkpoint_pending.clear()
+
+
+def clearCheckpoints(collection, jobId):
+    try:
+        logging.info("clearCheckpoints called...")
+        checkpoint_pending.clear()
+        collection.database[CHECKPOINT_COLLECTION].delete_many({"jobId": jobId})
+    except Exception as e:
+        logging.info("Exception happened in clearCheckpoints: " + str(e))
+
+
+def resetDownloadStats():
+    with download_stats_lock:
+        for key in download_stats:
+            download_stats[key] = 0
+
+
+def countDownloadStat(key):
+    with download_stats_lock:
+        download_stats[key] += 1
+
+
+def extractDownloadLink(content):
+    # Slices the href of <a id="downloadLink"> straight out of the page bytes, None when the markup
+    # is not in the expected shape
+    id_match = DOWNLOAD_LINK_ID.search(content)
+    if id_match is None:
+        return None
+    tag_start = content.rfind(b"<", 0, id_match.start())
+    if tag_start == -1 or ANCHOR_OPEN.match(content, tag_start) is None:
+        return None
+    tag_end = content.find(b">", id_match.end())
+    if tag_end == -1:
+        return None
+    href_match = HREF_ATTRIBUTE.search(content, tag_start, tag_end)
+    if href_match is None:
+        return None
+    href_end = content.find(href_match.group(1), href_match.end(), tag_end)
+    if href_end == -1:
+        return None
+    href = content[href_match.end():href_end]
+    if b"&" in href:
+        return None  # Entities need the full parser
+    try:
+        return href.decode('ascii')
+    except UnicodeDecodeError:
+        return None
+
+
+def getInvoicePage(url, stream=False):
+    response = http_session.get(url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), stream=stream)
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and len(retries.history) != 0:
+        countDownloadStat("retried")
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    return response
+
+
+def stream_base64_to_file(url, file_path_prefix):
+    # Decodes the downloadLink data URL into the file while the page is still arriving, so only a chunk
+    # of it is in memory at a time. Returns the written path, or None when the page is not in the
+    # expected shape and has to go through fetch_base64_from_page
+    with getInvoicePage(url, stream=True) as response:
+        chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        buffer = b""
+        href_match = None
+        for chunk in chunks:
+            buffer += chunk
+            href_match = HREF_DATA_URL.search(buffer)
+            if href_match is not None:
+                break
+            buffer = buffer[-STREAM_SCAN_TAIL:]
+        if href_match is None:
+            return None
+
+        tag_start = buffer.rfind(b"<", 0, href_match.start())
+        if tag_start == -1 or ANCHOR_OPEN.match(buffer, tag_start) is None \
+                or buffer.find(b">", tag_start, href_match.start()) != -1:
+            return None
+        id_in_tag = DOWNLOAD_LINK_ID.search(buffer, tag_start, href_match.start()) is not None
+        quote = href_match.group(1)
+
+        # The data URL header (data:<mime>;base64) ends at the first comma
+        header_start = href_match.start(2)
+        while buffer.find(b",", header_start) == -1 and len(buffer) - header_start < STREAM_SCAN_TAIL:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return None
+            buffer += chunk
+        comma = buffer.find(b",", header_start)
+        if comma == -1:
+            return None
+        header = buffer[header_start:comma].decode('ascii', 'replace')
+        if not header.lower().endswith(";base64"):
+            return None
+        mime_type = header.split(';')[0].split(':')[1]
+        file_extension = MIME_TO_EXTENSION.get(mime_type, '.pdf')
+        file_path = file_path_prefix + file_extension
+        part_path = getPartPath(file_path)
+        logging.info("Downloading the file: " + str(file_path))
+
+        data = buffer[comma + 1:]
+        buffer = None
+        carry = b""
+        tag_rest = None
+        completed = False
+        try:
+            with open(part_path, 'wb') as file:
+                while True:
+                    end = data.find(quote)
+                    if end != -1:
+                        tag_rest = data[end + 1:]
+                        data = data[:end]
+                    data = carry + data.translate(None, b" \t\r\n")
+                    if len(data.translate(None, BASE64_ALPHABET)) != 0:
+                        return None
+                    # Only whole 4 character groups are decoded, the rest waits for the next chunk
+                    aligned = len(data) - len(data) % 4
+                    file.write(base64.b64decode(data[:aligned]))
+                    carry = data[aligned:]
+                    if tag_rest is not None:
+                        break
+                    data = next(chunks, None)
+                    if data is None:
+                        return None
+            if len(carry) != 0:
+                return None
+
+            if not id_in_tag:
+                # The id comes after the href, the rest of the tag has to name the downloadLink anchor
+                while tag_rest.find(b">") == -1 and len(tag_rest) < STREAM_SCAN_TAIL:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    tag_rest += chunk
+                tag_end = tag_rest.find(b">")
+                if tag_end == -1 or DOWNLOAD_LINK_ID.search(tag_rest, 0, tag_end) is None:
+                    return None
+
+            os.replace(part_path, file_path)
+            completed = True
+            return file_path
+        finally:
+            if not completed and os.path.exists(part_path):
+                os.remove(part_path)
+
+
+def fetch_base64_from_page(url):
+    element_id = 'downloadLink'
+    # Fetch the HTML content from the URL
+    response = getInvoicePage(url)
+
+    href = extractDownloadLink(response.content)
+    if href is not None:
+        return href
+
+    # Parse the HTML content
+    soup = BeautifulSoup(response.text, 'html.parser')
+
+    # Find the <a> tag with the specified ID and get the href attribute
+    anchor = soup.find('a', id=element_id)
+    if anchor and 'href' in anchor.attrs:
+        return anchor['href']
+    else:
+        return None
+
+
+def download_base64_file(base64_string, file_path):
+    logging.info("Downloading the file: " + str(file_path))
+    # Extract the MIME type and base64 data from the input string
+    mime_info, base64_data = base64_string.split(',', 1)
+
+    # Decode base64 to binary data
+    binary_data = base64.b64decode(base64_data)
+
+    # Save the binary data to a file, renamed into place so a half written blob is never picked up
+    part_path = getPartPath(file_path)
+    with open(part_path, 'wb') as file:
+        file.write(binary_data)
+    os.replace(part_path, file_path)
+
+
+def getPartPath(file_path):
+    return f"{file_path}.{os.getpid()}.{threading.get_ident()}.part"
+
+
+def getBlobKey(url):
+    filehash = url.split("/")[-1]
+    if BLOB_KEY_PATTERN.fullmatch(filehash) is None:
+        # Not usable as a file name, key the blob by the whole URL instead
+        filehash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return filehash
+
+
+def getBlobPrefix(blobKey):
+    return os.path.join(BLOB_CACHE_DIR, blobKey[:2], blobKey)
+
+
+def findCachedBlob(blobKey):
+    blob_prefix = getBlobPrefix(blobKey)
+    for file_extension in MIME_TO_EXTENSION.values():
+        if os.path.exists(blob_prefix + file_extension):
+            return blob_prefix + file_extension
+    return None
+
+
+def evictBlobCache(collection):
+    try:
+        logging.info("evictBlobCache called...")
+        # Blobs of interrupted jobs are kept until the job is resumed
+        protected = set()
+        for checkpoint in collection.database[CHECKPOINT_COLLECTION].find({}, {"_id": 0, "blob": 1}):
+            protected.add(os.path.normpath(checkpoint["blob"]))
+        blobs = []
+        total_size = 0
+        for root, dirs, files in os.walk(BLOB_CACHE_DIR):
+            for name in files:
+                blob_path = os.path.join(root, name)
+                stat = os.stat(blob_path)
+                if name.endswith(".part"):
+                    # Left behind by a run that died mid download
+                    if stat.st_mtime < time.time() - STALE_PART_SECONDS:
+                        os.remove(blob_path)
+                    continue
+                total_size += stat.st_size
+                # Recently used blobs may belong to a job that is running right now
+                if os.path.normpath(blob_path) not in protected and stat.st_mtime < time.time() - BLOB_IN_USE_SECONDS:
+                    blobs.append((stat.st_mtime, stat.st_size, blob_path))
+        blobs.sort()
+        evicted = 0
+        for mtime, size, blob_path in blobs:
+            if total_size <= BLOB_CACHE_MAX_BYTES:
+                break
+            os.remove(blob_path)
+            total_size -= size
+            evicted += 1
+        logging.info("Blob cache size: " + str(total_size) + " bytes, evicted: " + str(evicted))
+    except Exception as e:
+        logging.info("Exception happened in evictBlobCache: " + str(e))
+
+
+def getHostSemaphore(url):
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(PER_HOST_CONCURRENCY)
+        return host_semaphores[host]
+
+
+def downloadInvoice(url):
+    try:
+
+        blob_key = getBlobKey(url)
+        blob_path = findCachedBlob(blob_key)
+        if blob_path is not None:
+            try:
+                # mtime is the LRU clock for evictBlobCache
+                os.utime(blob_path)
+                countDownloadStat("cachehits")
+                return blob_path
+            except FileNotFoundError:
+                # Evicted since it was looked up, fetch it again
+                pass
+        countDownloadStat("cachemisses")
+
+        blob_prefix = getBlobPrefix(blob_key)
+        os.makedirs(os.path.dirname(blob_prefix), exist_ok=True)
+        base64_string = None
+        with getHostSemaphore(url):
+            blob_path = None
+            if STREAM_DECODE:
+                blob_path = stream_base64_to_file(url, blob_prefix)
+            if blob_path is None:
+                base64_string = fetch_base64_from_page(url)
+
+        if blob_path is None:
+            mime_type = base64_string.split(';')[0].split(':')[1]
+            file_extension = MIME_TO_EXTENSION.get(mime_type, '.pdf')
+            blob_path = f"{blob_prefix}{file_extension}"
+            download_base64_file(base64_string, blob_path)
+        return blob_path
+    except Exception as e:
+        logging.info("Exception happened in downloadInvoice for " + str(url) + ": " + str(e))
+        countDownloadStat("failed")
+        return None
+
+
+def downloadFile(lease, archive, invoiceLinks, filePathArr, getArchiveName):
+    try:
+        logging.info("downloadFile called...")
+        logging.info("No. of file to download: " + str(len(invoiceLinks)))
+        # Each unique invoice of the job is fetched once, later links to it reuse the same download
+        lease.check()
+        for i in range(len(invoiceLinks)):
+            blob_key = getBlobKey(invoiceLinks[i])
+            if blob_key not in download_index:
+                blob_path = checkpointed_blobs.get(blob_key)
+                if blob_path is not None and os.path.exists(blob_path):
+                    # Downloaded before the job was interrupted
+                    download_index[blob_key] = concurrent.futures.Future()
+                    download_index[blob_key].set_result(blob_path)
+                else:
+                    download_index[blob_key] = download_executor.submit(downloadInvoice, invoiceLinks[i])
+            pending_downloads.setdefault(download_index[blob_key], []).append(
+                (invoiceLinks[i], filePathArr, getArchiveName))
+            if len(pending_downloads) >= DOWNLOAD_WINDOW:
+                archiveDownloads(lease, archive, concurrent.futures.FIRST_COMPLETED)
+        # What finished meanwhile goes into the archive now, the rest stays in flight for the next folders
+        archiveDownloads(lease, archive, concurrent.futures.FIRST_COMPLETED, timeout=0)
+
+    except Exception as e:
+        logging.info("Exception happened in downloadFile: " + str(e))
+        # A failed archive write leaves the zip unusable, the job has to fail
+        raise
+
+
+def archiveDownloads(lease, archive, returnWhen, timeout=None):
+    global failed_entries
+    # A job that was lost stops before it archives anything more
+    lease.check()
+    # Entries are added from the job thread as downloads finish, zipfile is not thread safe
+    done, _ = concurrent.futures.wait(list(pending_downloads), timeout=timeout, return_when=returnWhen)
+    for future in done:
+        entries = pending_downloads.pop(future)
+        blob_path = future.result()
+        if blob_path is None:
+            failed_entries += len(entries)
+            continue
+        checkpointDownload(lease, getBlobKey(entries[0][0]), blob_path)
+        for url, filePathArr, getArchiveName in entries:
+            addFileEntry(archive, blob_path, getArchiveName(url, filePathArr, blob_path))
+
+
+def finishDownloads(lease, archive):
+    try:
+        logging.info("finishDownloads called...")
+        # One download at a time, so the lease is still checked while the last ones finish
+        while len(pending_downloads) != 0:
+            archiveDownloads(lease, archive, concurrent.futures.FIRST_COMPLETED)
+        if failed_entries != 0:
+            logging.info("No. of file failed to download: " + str(failed_entries))
+
+    except Exception as e:
+        logging.info("Exception happened in finishDownloads: " + str(e))
+        raise
@@ -0,0 +1,212 @@
+import time
+import os
+import logging
+import threading
+import multiprocessing
+import socket
+import tempfile
+import fcntl
+import concurrent.futures
+from datetime import datetime, timedelta, timezone
+from pymongo import ReturnDocument
+
+# Job ownership shared by send-report.py and the invoice scripts. Importing it opens no connection, the jobs
+# collection is handed in by the caller
+
+# How long a claimed job belongs to the worker that claimed it. The lease is renewed every third of that
+# while the job runs, a job whose lease ran out was left by a dead worker and is claimed again
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 600))
+# Leases are written with the clock of the host that holds them. Another host only takes a job over once the
+# lease expired by this much on its own clock, so clocks that are off by less than that do not matter
+LEASE_CLOCK_SKEW_SECONDS = int(os.getenv("LEASE_CLOCK_SKEW_SECONDS", 60))
+# Renewals that may fail in a row before the worker gives the job up, after that the lease may already be
+# expired for the other hosts
+MAX_MISSED_RENEWALS = 1
+
+# A job interrupted this many times is failed instead of being run again
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", 3))
+# S3 keys are grouped in buckets of this many seconds of job time
+BUCKET_SECONDS = 90 * 24 * 60 * 60
+
+# Workers running on this host at the same time, e.g. from overlapping cron runs. Each one runs up to
+# WORKER_CONCURRENCY jobs, further workers exit right away
+MAX_WORKERS_PER_HOST = int(os.getenv("MAX_WORKERS_PER_HOST", 1))
+HOST_LOCK_DIR = os.getenv("HOST_LOCK_DIR", tempfile.gettempdir())
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class JobLease:
+    # Ownership of one claimed job. renewLease keeps it alive in the background, and every write made for the
+    # job goes through update() so it only lands while this worker still owns the job. Once the lease is lost
+    # check() raises LeaseLost, the job stops at its next check and leaves everything to the new owner
+
+    def __init__(self, collection, job):
+        self.collection = collection
+        self.key = {"_id": job["_id"], "workerId": job["workerId"]}
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=renewLease, args=(self.collection, self.key, self.stopped, self.lost),
+                         daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self):
+        if self.lost.is_set():
+            raise LeaseLost("Lease lost for job: " + str(self.key["_id"]))
+
+    def checked(self, items):
+        # Checks the lease before handing out each item, so a long extraction stops once the job was lost
+        for item in items:
+            self.check()
+            yield item
+
+    def update(self, update, status=None):
+        # Fenced write, it only matches while the job still belongs to this worker (and is in status)
+        self.check()
+        key_to_check = dict(self.key)
+        if status is not None:
+            key_to_check["status"] = status
+        result = self.collection.update_one(key_to_check, update)
+        if result.matched_count == 0:
+            self.lost.set()
+            logging.info("No updates for the document: " + str(key_to_check) + " Update: " + str(update))
+            self.check()
+        logging.info("Updated the document: " + str(key_to_check) + " Update: " + str(update))
+        return result
+
+    def transition(self, fromStatus, toStatus):
+        # Moves the job on only if this worker still owns it. The lease is renewed with it, so the step that
+        # follows (upload, mail) starts with a full lease
+        self.update({"$set": {"status": toStatus, "leaseExpiresAt": getLeaseExpiry()}}, fromStatus)
+
+    def confirm(self):
+        # Fenced ownership check right before a side effect that cannot be fenced itself, e.g. the mail
+        self.update({"$set": {"leaseExpiresAt": getLeaseExpiry()}})
+
+
+def getLeaseExpiry():
+    return datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)
+
+
+def renewLease(collection, key_to_check, stopped, lost):
+    missed = 0
+    while not stopped.wait(JOB_LEASE_SECONDS / 3):
+        try:
+            result = collection.update_one(key_to_check, {"$set": {"leaseExpiresAt": getLeaseExpiry()}})
+            if result.matched_count == 0:
+                # Reclaimed by another worker, the job is aborted at its next lease check
+                logging.info("Lease lost for job: " + str(key_to_check["_id"]))
+                lost.set()
+                return
+            missed = 0
+        except Exception as e:
+            logging.info("Exception happened in renewLease: " + str(e))
+            missed += 1
+            if missed > MAX_MISSED_RENEWALS:
+                logging.info("Lease could not be renewed, giving up job: " + str(key_to_check["_id"]))
+                lost.set()
+                return
+
+
+def claimJob(collection, workerId, jobFilter):
+    logging.info("claimJob called...")
+    update = {
+        "$set": {
+            "status": "IN PROGRESS",
+            "workerId": workerId,
+            "leaseExpiresAt": getLeaseExpiry()
+        },
+        "$inc": {
+            "attempts": 1
+        }
+    }
+    # Status is checked and set in one step, so a job is never picked up by two workers. A job still
+    # IN PROGRESS or FINALIZING with an expired lease was left by a dead worker, it is run again before new jobs
+    expired_before = datetime.now(timezone.utc) - timedelta(seconds=LEASE_CLOCK_SKEW_SECONDS)
+    expired = {"$or": [{"leaseExpiresAt": {"$lt": expired_before}}, {"leaseExpiresAt": {"$exists": False}}]}
+    job = collection.find_one_and_update({"status": {"$in": ["IN PROGRESS", "FINALIZING"]}, **expired, **jobFilter},
+                                         update, sort=[("createdBy", -1)], return_document=ReturnDocument.AFTER)
+    if job is None:
+        job = collection.find_one_and_update({"status": "PENDING", **jobFilter},
+                                             update, sort=[("createdBy", -1)], return_document=ReturnDocument.AFTER)
+    return job
+
+
+def getJobTimes(jobtime):
+    # File names and S3 keys are derived from the job time, every job gets its own (see runWorker)
+    return jobtime, int(jobtime / BUCKET_SECONDS)
+
+
+def runLeasedJob(collection, job, runJob, failJob=None, finishJob=None):
+    # Runs runJob(job, lease) while the lease is held. A job that used up MAX_JOB_ATTEMPTS is set FAILED and
+    # handed to failJob(job) instead. A lost lease ends the job quietly, finishJob() runs after every job
+    logging.info("Processing for job: " + str(job))
+    lease = JobLease(collection, job)
+    lease.start()
+    try:
+        # attempts already counts this run, it is incremented when the job is claimed
+        if job.get("attempts", 0) > MAX_JOB_ATTEMPTS:
+            lease.update({"$set": {"status": "FAILED"}})
+            if failJob is not None:
+                failJob(job)
+        else:
+            runJob(job, lease)
+    except LeaseLost as e:
+        logging.info(str(e) + ", the job is left to the worker that owns it now")
+    finally:
+        lease.stop()
+        if finishJob is not None:
+            finishJob()
+
+
+def acquireHostSlot(name):
+    # Non blocking lock on one of MAX_WORKERS_PER_HOST slot files, held until the process exits. None when
+    # every slot is taken
+    os.makedirs(HOST_LOCK_DIR, exist_ok=True)
+    for slot in range(MAX_WORKERS_PER_HOST):
+        lock_file = open(os.path.join(HOST_LOCK_DIR, f"{name}.{slot}.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except OSError:
+            lock_file.close()
+    return None
+
+
+def runWorker(collection, jobFilter, processJob, concurrency, afterJob=None):
+    # afterJob(collection) runs here, in the worker that holds the host slot, once each job has finished
+    logging.info("runWorker called...")
+    workerId = socket.gethostname() + "-" + str(os.getpid())
+    jobtime = 0
+    claimed = 0
+    running = set()
+    # spawn gives every job process its own Postgres and Mongo connections
+    with concurrent.futures.ProcessPoolExecutor(max_workers=concurrency,
+                                                mp_context=multiprocessing.get_context("spawn")) as executor:
+        while True:
+            while len(running) < concurrency:
+                job = claimJob(collection, workerId, jobFilter)
+                if job is None:
+                    break
+                claimed += 1
+                # File names and S3 keys are derived from the job time, every job gets its own
+                jobtime = max(int(time.time()), jobtime + 1)
+                running.add(executor.submit(processJob, job, jobtime))
+            if len(running) == 0:
+                break
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.info("Exception happened in processJob: " + str(e))
+                if afterJob is not None:
+                    afterJob(collection)
+    if claimed == 0:
+        logging.info("No pending jobs")
@@ -0,0 +1,40 @@
+import re
+import weakref
+from psycopg2 import sql
+
+# Postgres query helpers shared by send-report.py and invoice-send-report.py. Importing it opens no connection,
+# the cursor is handed in by the caller
+
+# One part of a possibly schema qualified table name, "quoted" or plain
+TABLE_NAME_PART = re.compile(r'"((?:[^"]|"")*)"|([^."]+)')
+
+# Names of the statements prepared on each connection, see executePrepared
+prepared_statements = weakref.WeakKeyDictionary()
+
+
+def getTableIdentifier(tablename):
+    # Table names may be schema qualified, each part is quoted on its own. Parts are folded to lower case the
+    # way Postgres folds an unquoted name, unless the job gives them in double quotes
+    parts = []
+    for quoted, unquoted in TABLE_NAME_PART.findall(tablename):
+        if unquoted:
+            parts.append(unquoted.strip().lower())
+        else:
+            parts.append(quoted.replace('""', '"'))
+    return sql.Identifier(*parts)
+
+
+def executePrepared(cursor, name, query, params, types=None):
+    # query uses $1, $2 ... placeholders. The lookups using this run once per job, so the statement is not
+    # reused within a job: it is prepared on the first call on the connection, one extra round trip, and
+    # the later jobs the pool process runs on the same connection only EXECUTE it. types declares the
+    # parameter types where the value psycopg2 sends would not coerce to the type Postgres infers, e.g. a
+    # Python list is text[]
+    prepared = prepared_statements.setdefault(cursor.connection, set())
+    if name not in prepared:
+        if types is not None:
+            cursor.execute(f"PREPARE {name}({', '.join(types)}) AS {query}")
+        else:
+            cursor.execute(f"PREPARE {name} AS {query}")
+        prepared.add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
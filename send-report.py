@@ -1,6 +1,6 @@
 import time
-from tendo import singleton
 import psycopg2
+from psycopg2 import sql
 import os
 from dotenv import load_dotenv
 
@@ -13,11 +13,26 @@ import requests
 from sendgrid.helpers.mail import Mail
 from openpyxl.styles import Border, Side, Font, Alignment, PatternFill
 import hashlib
+import csv
+import gzip
+import itertools
+import concurrent.futures
+import multiprocessing
+import re
+import tempfile
+import zipfile
+import queue
+import threading
 from openpyxl.drawing.image import Image
-from datetime import datetime
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from datetime import datetime, timedelta
 import pytz
 from openpyxl.styles import NamedStyle
 from logging.handlers import TimedRotatingFileHandler
+from pg_query import getTableIdentifier, executePrepared
+from job_lease import getJobTimes, runLeasedJob, runWorker, acquireHostSlot
 
 ist = pytz.timezone('Asia/Kolkata')
 folder_path = "log/"
@@ -55,30 +70,84 @@ SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY')
 MONGO_URL = os.getenv('MONGO_URL')
 client = MongoClient(MONGO_URL, maxIdleTimeMS=None)
 logging.info("Mongo connection successful")
-
-pgconn = psycopg2.connect(
-    host=postgres_host,
-    database=postgres_db,
-    port=postgres_port,
-    user=postgres_user,
-    password=postgres_password
-)
-
-LIMIT = 1
+collection = client['gstservice']['recon_report']
+
+
+
+def connectPostgres():
+    return psycopg2.connect(
+        host=postgres_host,
+        database=postgres_db,
+        port=postgres_port,
+        user=postgres_user,
+        password=postgres_password
+    )
+
+
+pgconn = connectPostgres()
+
+# Jobs run at the same time by this worker, each in its own process
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 1))
+
+# Rows pulled per round trip by the server-side cursor and rows per DataFrame batch handed to the writer
+PG_ITERSIZE = int(os.getenv("PG_ITERSIZE", 5000))
+BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", 10000))
+SHEET_ROWS = 10000
+# Processes rendering Sheet{n} XML in parallel, 1 writes the sheets one after another
+SHEET_WORKERS = int(os.getenv("SHEET_WORKERS", 1))
+DATA_HEADER_FONT = Font(size=12, bold=True)
+DATA_HEADER_FILL = PatternFill(start_color="f5f6f9", end_color="f5f6f9", fill_type="solid")
+SHARED_STRING_CELL = re.compile(rb'(<c\b[^>]*\bt="s"[^>]*>\s*<v>)(\d+)(</v>)')
+
+# Full-table (admin) exports are split into ctid block ranges read over this many connections
+EXTRACT_PARTITIONS = int(os.getenv("EXTRACT_PARTITIONS", 1))
+# Batches buffered per partition while earlier partitions are still being consumed
+PARTITION_PREFETCH = int(os.getenv("PARTITION_PREFETCH", 4))
+
+OUTPUT_EXTENSIONS = {
+    "xlsx": ".xlsx",
+    "csv.gz": ".csv.gz",
+    "parquet": ".parquet",
+}
+# xlsx reports above this many rows are written as csv.gz instead
+XLSX_MAX_ROWS = int(os.getenv("XLSX_MAX_ROWS", 500000))
+
+# cursor, copy or auto (COPY TO STDOUT once the planner estimates at least COPY_ROW_THRESHOLD rows).
+# benchmarks/bench_copy_extraction.py measured COPY within 10% of the cursor up to 2M rows on a local
+# server, so the cursor stays the default until the benchmark shows a gain against the production database
+EXTRACT_BACKEND = os.getenv("EXTRACT_BACKEND", "cursor")
+COPY_ROW_THRESHOLD = int(os.getenv("COPY_ROW_THRESHOLD", 200000))
+
+# int2, int4, int8, float4, float8, money, numeric
+NUMERIC_TYPE_OIDS = {21, 23, 20, 700, 701, 790, 1700}
+# int2, int4, int8
+INTEGER_TYPE_OIDS = {21, 23, 20}
+TIMESTAMP_TYPE_OID = 1114
+TIMESTAMPTZ_TYPE_OID = 1184
+# Column types COPY sends as text that parseCopyColumns turns back into what psycopg2 returns
+MONEY_TYPE_OID = 790
+BOOL_TYPE_OID = 16
+DATE_TYPE_OID = 1082
+TIMESTAMP_TYPE_OIDS = {TIMESTAMP_TYPE_OID, TIMESTAMPTZ_TYPE_OID}
+CATEGORY_MAX_RATIO = float(os.getenv("CATEGORY_MAX_RATIO", 0.5))
+NUMERIC_TEXT_PATTERN = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
 
 currtime = int(time.time())
 bucket_time = int(currtime / (90 * 24 * 60 * 60))
 
 
+# List of common date and datetime formats to try
+DATE_FORMATS = [
+    "%d/%m/%Y", "%Y-%m-%d", "%m/%d/%Y", "%d-%b-%Y", "%d %b %Y", "%Y%m%d",  # Date-only formats
+    "%d/%m/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%m/%d/%Y %H:%M:%S",  # Date and time formats
+    "%d/%m/%Y %H:%M", "%Y-%m-%d %H:%M", "%m/%d/%Y %H:%M",  # Without seconds
+    "%d-%b-%Y %H:%M:%S", "%d %b %Y %H:%M:%S", "%d-%m-%Y"  # Other common variations
+]
+DATE_SAMPLE_SIZE = int(os.getenv("DATE_SAMPLE_SIZE", 100))
+
+
 def try_convert_to_date(value):
-    # List of common date and datetime formats to try
-    date_formats = [
-        "%d/%m/%Y", "%Y-%m-%d", "%m/%d/%Y", "%d-%b-%Y", "%d %b %Y", "%Y%m%d",  # Date-only formats
-        "%d/%m/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%m/%d/%Y %H:%M:%S",  # Date and time formats
-        "%d/%m/%Y %H:%M", "%Y-%m-%d %H:%M", "%m/%d/%Y %H:%M",  # Without seconds
-        "%d-%b-%Y %H:%M:%S", "%d %b %Y %H:%M:%S", "%d-%m-%Y"  # Other common variations
-    ]
-    for fmt in date_formats:
+    for fmt in DATE_FORMATS:
         try:
             return datetime.strptime(str(value), fmt), fmt  # Return the date and format
         except (ValueError, TypeError):
@@ -86,6 +155,60 @@ def try_convert_to_date(value):
     return None, None  # Return None if conversion fails
 
 
+def detectDateFormat(text_values):
+    # Pick the format for the whole column from a sample, in the same precedence order as try_convert_to_date
+    sample = text_values.head(DATE_SAMPLE_SIZE)
+    if len(sample) == 0:
+        return None
+    best_format = None
+    best_matches = 0
+    for fmt in DATE_FORMATS:
+        matches = pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum()
+        if matches == len(sample):
+            return fmt
+        if matches > best_matches:
+            best_format = fmt
+            best_matches = matches
+    return best_format
+
+
+def normalizeDateColumn(series, fmt=None):
+    # Returns the cell values, the style to apply per cell ("date", "datetime" or None) and the column format
+    values = series.astype(object).where(series.notna(), None).tolist()
+    styles = [None] * len(values)
+    if pd.api.types.is_datetime64_dtype(series):
+        for i in range(len(values)):
+            if values[i] is not None:
+                values[i] = values[i].to_pydatetime()
+                styles[i] = "datetime"
+        return values, styles, fmt
+
+    mask = series.notna()
+    text_values = series.astype(str).where(mask)
+    if fmt is None:
+        fmt = detectDateFormat(text_values[mask])
+    if fmt is not None:
+        column_style = "datetime" if "%H:%M" in fmt else "date"
+        parsed = pd.to_datetime(text_values, format=fmt, errors='coerce')
+        for i, date_value in enumerate(parsed.tolist()):
+            if not pd.isna(date_value):
+                values[i] = date_value.to_pydatetime()
+                styles[i] = column_style
+
+    # Cells the column format did not match go through the per cell formats
+    for i in range(len(values)):
+        if values[i] is not None and styles[i] is None:
+            date_value, format_used = try_convert_to_date(values[i])
+            if date_value:
+                values[i] = date_value
+                # Apply datetime format if time is included, otherwise apply date format
+                if "%H:%M" in format_used or "%H:%M:%S" in format_used:
+                    styles[i] = "datetime"
+                else:
+                    styles[i] = "date"
+    return values, styles, fmt
+
+
 def sendMailToClient(to_emails, template_id, dynamic_template_data):
     logging.info("sendMailToClient called...")
     api_key = SENDGRID_API_KEY
@@ -149,9 +272,9 @@ def findFileHash(file_path, hash_algo='sha256'):
 def getCreatedBy(createdbyId):
     logging.info("getCreatedBy is called...")
     with pgconn.cursor() as cursor:
-        select_query = f"SELECT name FROM users WHERE id='{createdbyId}'"
+        select_query = "SELECT name FROM users WHERE id = $1"
         logging.info("Query: " + str(select_query))
-        cursor.execute(select_query)
+        executePrepared(cursor, "recon_created_by", select_query, (createdbyId,))
         results = cursor.fetchall()
         if results is None or len(results) == 0:
             return createdbyId
@@ -160,200 +283,765 @@ def getCreatedBy(createdbyId):
                 return row[0]
 
 
-def xlsxWriter(filename, schemaName, header_details, hyperlink_headers, date_headers, createdbyId, df):
+def rechunkBatches(batches, size):
+    pending = []
+    pending_rows = 0
+    for batch in batches:
+        while len(batch) != 0:
+            part = batch.iloc[:size - pending_rows]
+            batch = batch.iloc[len(part):]
+            pending.append(part)
+            pending_rows += len(part)
+            if pending_rows == size:
+                yield pd.concat(pending, ignore_index=True)
+                pending = []
+                pending_rows = 0
+    if pending_rows != 0:
+        yield pd.concat(pending, ignore_index=True)
+
+
+def styledCell(ws, value=None, font=None, fill=None, border=None, alignment=None):
+    cell = WriteOnlyCell(ws, value=value)
+    if font is not None:
+        cell.font = font
+    if fill is not None:
+        cell.fill = fill
+    if border is not None:
+        cell.border = border
+    if alignment is not None:
+        cell.alignment = alignment
+    return cell
+
+
+def writeCoverSheet(cover_ws, schemaName, header_details, createdbyId):
+    cover_image_path = './finkraftlogo.png'
+    header_row = ["Column Name", "Data Type", "Agg Type", "Agg Value", "Group Name", "UI Format Type",
+                  "Grouping", "Pivot"]
+
+    # Merge columns A to D and rows 1 to 4
+    cover_ws.merged_cells.add('A1:D4')
+
+    # Add image to cover sheet
+    if cover_image_path and os.path.isfile(cover_image_path):
+        img = Image(cover_image_path)
+
+        # Calculate width of columns A to D
+        total_width = (cover_ws.column_dimensions['A'].width or 10) + \
+                      (cover_ws.column_dimensions['B'].width or 10) + \
+                      (cover_ws.column_dimensions['C'].width or 10) + \
+                      (cover_ws.column_dimensions['D'].width or 10)
+
+        # Calculate height of rows 1 to 4
+        total_height = (cover_ws.row_dimensions[1].height or 15) + \
+                       (cover_ws.row_dimensions[2].height or 15) + \
+                       (cover_ws.row_dimensions[3].height or 15) + \
+                       (cover_ws.row_dimensions[4].height or 15)
+
+        # Adjust the image size to fit the merged cells
+        img.width = total_width * 7.5  # Approximate width in pixels
+        img.height = total_height * 1.2  # Approximate height in pixels
+
+        # Place the image in the merged area (A1)
+        cover_ws.add_image(img, 'A1')
+
+    # Column widths are written with the sheet header, so they have to be set before the first row
+    widths_source = header_details + [header_row]
+    for col_idx in range(1, 8):  # Columns A to G (1-based index)
+        max_length = 0
+        for row_data in widths_source:
+            if len(str(row_data[col_idx - 1])) > max_length:
+                max_length = len(str(row_data[col_idx - 1]))
+
+        # Set column width (slightly larger to accommodate characters)
+        adjusted_width = max_length + 4  # Add some padding for better spacing
+        cover_ws.column_dimensions[get_column_letter(col_idx)].width = adjusted_width
+
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+
+    # Apply the border to the merged cells (A1:D4)
+    for _ in range(4):
+        cover_ws.append([styledCell(cover_ws, border=thin_border) for _ in range(4)])
+    cover_ws.append([])
+    cover_ws.append([])
+
+    mainheader_color = PatternFill(start_color="FFFF99", end_color="FFFF99", fill_type="solid")
+    cover_ws.merged_cells.add('A7:D7')
+    schemaNameRow = [styledCell(cover_ws, value=schemaName, font=Font(size=16, bold=True),
+                                alignment=Alignment(horizontal='center', vertical='center'),
+                                border=thin_border, fill=mainheader_color)]
+    schemaNameRow += [styledCell(cover_ws, border=thin_border, fill=mainheader_color) for _ in range(3)]
+    cover_ws.append(schemaNameRow)
+
+    current_time_ist = datetime.now(ist)
+    current_date_formatted = current_time_ist.strftime("%d/%m/%Y")
+    createdBy = getCreatedBy(createdbyId)
+    cover_ws.append([styledCell(cover_ws, value=value, font=Font(size=12, bold=True), border=thin_border,
+                                fill=mainheader_color)
+                     for value in ["Created On", current_date_formatted, "Created By", createdBy]])
+    cover_ws.append([])
+
+    header_color = PatternFill(start_color="6AA84F", end_color="6AA84F", fill_type="solid")
+    cover_ws.append([styledCell(cover_ws, value=value, font=Font(size=13, bold=True), border=thin_border,
+                                fill=header_color)
+                     for value in header_row])
+
+    data_color = PatternFill(start_color="FFEBD6", end_color="FFEBD6", fill_type="solid")
+    for row_data in header_details:
+        row = [styledCell(cover_ws, value=row_data[0], font=Font(bold=True, size=10), border=thin_border,
+                          fill=data_color)]
+        row += [styledCell(cover_ws, value=value, border=thin_border, fill=data_color) for value in row_data[1:8]]
+        cover_ws.append(row)
+
+
+def getDateStyles():
+    return {
+        "date": NamedStyle(name="date", number_format='DD/MM/YYYY'),
+        "datetime": NamedStyle(name="datetime", number_format='DD/MM/YYYY HH:MM:SS'),
+    }
+
+
+def primeStyles(ws, date_styles):
+    # Registers every style a data sheet can use in a fixed order, so a sheet rendered in its own
+    # workbook refers to the same style ids as the final workbook
+    cells = [
+        styledCell(ws, font=DATA_HEADER_FONT, fill=DATA_HEADER_FILL),
+        WriteOnlyCell(ws, value=datetime(2000, 1, 1)),
+        WriteOnlyCell(ws, value=datetime(2000, 1, 1).date()),
+        WriteOnlyCell(ws, value=datetime(2000, 1, 1).time()),
+        WriteOnlyCell(ws, value=timedelta(0)),
+    ]
+    hyperlink_cell = WriteOnlyCell(ws)
+    hyperlink_cell.style = "Hyperlink"
+    cells.append(hyperlink_cell)
+    for name in ["date", "datetime"]:
+        date_cell = WriteOnlyCell(ws)
+        date_cell.style = date_styles[name]
+        cells.append(date_cell)
+    for cell in cells:
+        cell.style_id  # Reading the id is what adds the style to the workbook
+
+
+def writeDataSheet(ws, df_chunk, hyperlink_headers, date_headers, date_formats, date_styles):
+    header_row = list(df_chunk.columns)
+    ws.append([styledCell(ws, value=header, font=DATA_HEADER_FONT, fill=DATA_HEADER_FILL) for header in header_row])
+
+    # Identify columns that should be hyperlinks or dates based on header names
+    hyperlink_columns = [header_row.index(header) for header in hyperlink_headers if header in header_row]
+    date_columns = {}
+    for header in date_headers:
+        if header in header_row:
+            col_idx = header_row.index(header)
+            date_values, styles, date_formats[header] = normalizeDateColumn(df_chunk.iloc[:, col_idx],
+                                                                            date_formats.get(header))
+            date_columns[col_idx] = (date_values, styles)
+
+    values = df_chunk.astype(object).where(pd.notna(df_chunk), None)
+    for row_num, row in enumerate(values.itertuples(index=False, name=None)):
+        row = list(row)
+        for col_idx in hyperlink_columns:
+            cell_value = row[col_idx]
+            if cell_value is not None:
+                cell = WriteOnlyCell(ws, value=cell_value)  # Set the display text
+                cell.hyperlink = cell_value  # Set the URL as the hyperlink
+                cell.style = "Hyperlink"
+                row[col_idx] = cell
+
+        for col_idx, (date_values, styles) in date_columns.items():
+            if styles[row_num] is not None:
+                cell = WriteOnlyCell(ws, value=date_values[row_num])
+                cell.style = date_styles[styles[row_num]]
+                row[col_idx] = cell
+        ws.append(row)
+
+    ws.auto_filter.ref = f"A1:{get_column_letter(len(header_row))}{len(df_chunk) + 1}"
+
+
+def detectDateFormats(df_chunk, date_headers, date_formats):
+    # Detects the columns writeDataSheet would detect on this chunk, so parts rendered in parallel share
+    # the formats of the first chunk like the sheets written one after another do
+    header_row = list(df_chunk.columns)
+    for header in date_headers:
+        if header in header_row and date_formats.get(header) is None:
+            series = df_chunk.iloc[:, header_row.index(header)]
+            if not pd.api.types.is_datetime64_dtype(series):
+                mask = series.notna()
+                date_formats[header] = detectDateFormat(series.astype(str).where(mask)[mask])
+    return date_formats
+
+
+def renderSheetPart(df_chunk, hyperlink_headers, date_headers, date_formats, part_path):
+    # Runs in a worker process, the sheet is saved as a one sheet workbook and spliced in by assembleWorkbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="Sheet")
+    date_styles = getDateStyles()
+    primeStyles(ws, date_styles)
+    writeDataSheet(ws, df_chunk, hyperlink_headers, date_headers, date_formats, date_styles)
+    wb.save(part_path)
+    return part_path
+
+
+def readSharedStrings(xlsx_zip):
+    if "xl/sharedStrings.xml" not in xlsx_zip.namelist():
+        return b"", 0
+    shared_strings = xlsx_zip.read("xl/sharedStrings.xml")
+    if b"</sst>" not in shared_strings:
+        return b"", 0
+    start = shared_strings.index(b">", shared_strings.index(b"<sst")) + 1
+    body = shared_strings[start:shared_strings.rindex(b"</sst>")]
+    return body, body.count(b"<si>") + body.count(b"<si ")
+
+
+def assembleWorkbook(filename, part_paths):
+    logging.info("assembleWorkbook called...")
+    # Cover is sheet1.xml, Sheet{n} placeholders are sheet{n + 1}.xml
+    sheet_parts = {}
+    for idx in range(len(part_paths)):
+        sheet_parts[f"xl/worksheets/sheet{idx + 2}.xml"] = part_paths[idx]
+
+    assembled = filename + ".assembling"
+    with zipfile.ZipFile(filename) as main_zip, \
+            zipfile.ZipFile(assembled, 'w', zipfile.ZIP_DEFLATED) as out_zip:
+        main_strings, main_count = readSharedStrings(main_zip)
+        # Each part numbers its shared strings from 0, they move up by the strings of everything before it
+        string_offsets = {}
+        string_count = main_count
+        for part_path in part_paths:
+            with zipfile.ZipFile(part_path) as part_zip:
+                string_offsets[part_path] = string_count
+                string_count += readSharedStrings(part_zip)[1]
+
+        for item in main_zip.infolist():
+            if item.filename in sheet_parts:
+                part_path = sheet_parts[item.filename]
+                with zipfile.ZipFile(part_path) as part_zip:
+                    sheet_xml = part_zip.read("xl/worksheets/sheet1.xml")
+                    offset = string_offsets[part_path]
+                    if offset != 0:
+                        sheet_xml = SHARED_STRING_CELL.sub(
+                            lambda match: match.group(1) + str(int(match.group(2)) + offset).encode() + match.group(3),
+                            sheet_xml)
+                    out_zip.writestr(item.filename, sheet_xml)
+                    if "xl/worksheets/_rels/sheet1.xml.rels" in part_zip.namelist():
+                        rels_name = item.filename.replace("xl/worksheets/", "xl/worksheets/_rels/") + ".rels"
+                        out_zip.writestr(rels_name, part_zip.read("xl/worksheets/_rels/sheet1.xml.rels"))
+            elif item.filename == "xl/sharedStrings.xml":
+                with out_zip.open(item.filename, 'w') as out_strings:
+                    out_strings.write(b'<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                                      + f'count="{string_count}" uniqueCount="{string_count}">'.encode())
+                    out_strings.write(main_strings)
+                    for part_path in part_paths:
+                        with zipfile.ZipFile(part_path) as part_zip:
+                            out_strings.write(readSharedStrings(part_zip)[0])
+                    out_strings.write(b"</sst>")
+            else:
+                out_zip.writestr(item, main_zip.read(item.filename))
+    os.replace(assembled, filename)
+
+
+def renderDataSheetParts(wb, batches, hyperlink_headers, date_headers, part_dir):
+    logging.info("renderDataSheetParts called...")
+    total_records = 0
+    part_paths = []
+    in_flight = []
+    # Date format detected per column on the first chunk and handed to every part
+    date_formats = {}
+    # spawn like runWorker, forking this job process would copy its lease, pymongo and extraction threads
+    with concurrent.futures.ProcessPoolExecutor(max_workers=SHEET_WORKERS,
+                                                mp_context=multiprocessing.get_context("spawn")) as executor:
+        for chunk_num, df_chunk in enumerate(rechunkBatches(batches, SHEET_ROWS)):
+            total_records += len(df_chunk)
+            # Empty placeholder, its sheet XML is replaced by the rendered part
+            ws = wb.create_sheet(title=f"Sheet{chunk_num + 1}")
+            ws.auto_filter.ref = f"A1:{get_column_letter(len(df_chunk.columns))}{len(df_chunk) + 1}"
+            part_path = os.path.join(part_dir, f"sheet{chunk_num + 1}.xlsx")
+            part_paths.append(part_path)
+            detectDateFormats(df_chunk, date_headers, date_formats)
+            in_flight.append(executor.submit(renderSheetPart, df_chunk, hyperlink_headers, date_headers,
+                                             dict(date_formats), part_path))
+
+            # Only a few chunks wait in the pool so memory does not grow with the report
+            if len(in_flight) >= SHEET_WORKERS * 2:
+                done, pending = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                in_flight = list(pending)
+        for future in in_flight:
+            future.result()
+    return total_records, part_paths
+
+
+def xlsxWriter(filename, schemaName, header_details, hyperlink_headers, date_headers, createdbyId, batches):
     try:
-        cover_image_path = './finkraftlogo.png'
-        # Create the cover sheet
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            wb = writer.book
-            cover_ws = wb.create_sheet(title='Cover')
-
-            # Merge columns A to D and rows 1 to 4
-            cover_ws.merge_cells('A1:D4')
-
-            # Add image to cover sheet
-            if cover_image_path and os.path.isfile(cover_image_path):
-                img = Image(cover_image_path)
-
-                # Calculate width of columns A to D
-                total_width = (cover_ws.column_dimensions['A'].width or 10) + \
-                              (cover_ws.column_dimensions['B'].width or 10) + \
-                              (cover_ws.column_dimensions['C'].width or 10) + \
-                              (cover_ws.column_dimensions['D'].width or 10)
-
-                # Calculate height of rows 1 to 4
-                total_height = (cover_ws.row_dimensions[1].height or 15) + \
-                               (cover_ws.row_dimensions[2].height or 15) + \
-                               (cover_ws.row_dimensions[3].height or 15) + \
-                               (cover_ws.row_dimensions[4].height or 15)
-
-                # Adjust the image size to fit the merged cells
-                img.width = total_width * 7.5  # Approximate width in pixels
-                img.height = total_height * 1.2  # Approximate height in pixels
-
-                # Place the image in the merged area (A1)
-                cover_ws.add_image(img, 'A1')
-
-            thin_border = Border(
-                left=Side(style='thin'),
-                right=Side(style='thin'),
-                top=Side(style='thin'),
-                bottom=Side(style='thin')
-            )
+        # Write-only workbook streams each row to disk instead of keeping a cell tree per sheet
+        wb = Workbook(write_only=True)
+        cover_ws = wb.create_sheet(title='Cover')
+        date_styles = getDateStyles()
+        primeStyles(cover_ws, date_styles)
+        writeCoverSheet(cover_ws, schemaName, header_details, createdbyId)
+
+        if SHEET_WORKERS > 1:
+            with tempfile.TemporaryDirectory() as part_dir:
+                total_records, part_paths = renderDataSheetParts(wb, batches, hyperlink_headers, date_headers,
+                                                                 part_dir)
+                wb.save(filename)
+                assembleWorkbook(filename, part_paths)
+            return total_records
+
+        # Date format detected per column on the first chunk and reused for the following ones
+        date_formats = {}
+        total_records = 0
 
-            # Apply the border to the merged cells (A1:D4)
-            for row in cover_ws.iter_rows(min_row=1, max_row=4, min_col=1, max_col=4):
-                for cell in row:
-                    cell.border = thin_border
-
-            cover_ws.merge_cells('A7:D7')
-            schemaNameCellStart = 7
-            schemaNameCell = cover_ws.cell(row=schemaNameCellStart, column=1, value=schemaName)
-            schemaNameCell.font = Font(size=16, bold=True)
-            schemaNameCell.alignment = Alignment(horizontal='center', vertical='center')
-
-            createdInfoCellStart = 8
-            createdAtCell = cover_ws.cell(row=createdInfoCellStart, column=1, value="Created On")
-            createdAtCell.font = Font(size=12, bold=True)
-
-            current_time_ist = datetime.now(ist)
-            current_date_formatted = current_time_ist.strftime("%d/%m/%Y")
-            createdAtValCell = cover_ws.cell(row=createdInfoCellStart, column=2, value=current_date_formatted)
-            createdAtValCell.font = Font(size=12, bold=True)
-
-            createdByCell = cover_ws.cell(row=createdInfoCellStart, column=3, value="Created By")
-            createdByCell.font = Font(size=12, bold=True)
-
-            createdBy = getCreatedBy(createdbyId)
-            createdByValCell = cover_ws.cell(row=createdInfoCellStart, column=4, value=createdBy)
-            createdByValCell.font = Font(size=12, bold=True)
-
-            mainheader_color = PatternFill(start_color="FFFF99", end_color="FFFF99", fill_type="solid")
-            for row in cover_ws.iter_rows(min_row=schemaNameCellStart, max_row=createdInfoCellStart, min_col=1,
-                                          max_col=4):
-                for cell in row:
-                    cell.border = thin_border
-                    cell.fill = mainheader_color
-
-            headerCellStart = 10
-            header_row = ["Column Name", "Data Type", "Agg Type", "Agg Value", "Group Name", "UI Format Type",
-                          "Grouping", "Pivot"]
-            for col_idx, value in enumerate(header_row, start=1):
-                cell = cover_ws.cell(row=headerCellStart, column=col_idx, value=value)
-                cell.font = Font(size=13, bold=True)
-            header_color = PatternFill(start_color="6AA84F", end_color="6AA84F", fill_type="solid")
-            for row in cover_ws.iter_rows(min_row=headerCellStart, max_row=headerCellStart, min_col=1, max_col=8):
-                for cell in row:
-                    cell.border = thin_border
-                    cell.fill = header_color
-
-            dataCellStart = 11
-            dataCellEnd = 11
-            for row_idx, row_data in enumerate(header_details, start=dataCellStart):
-                cell_a = cover_ws.cell(row=row_idx, column=1, value=row_data[0])
-                cell_a.font = Font(bold=True, size=10)
-                cover_ws.cell(row=row_idx, column=2, value=row_data[1])
-                cover_ws.cell(row=row_idx, column=3, value=row_data[2])
-                cover_ws.cell(row=row_idx, column=4, value=row_data[3])
-                cover_ws.cell(row=row_idx, column=5, value=row_data[4])
-                cover_ws.cell(row=row_idx, column=6, value=row_data[5])
-                cover_ws.cell(row=row_idx, column=7, value=row_data[6])
-                cover_ws.cell(row=row_idx, column=8, value=row_data[7])
-                dataCellEnd += 1
-
-            header_details.append(header_row)
-            for col_idx in range(1, 8):  # Columns A, B, C (1-based index)
-                max_length = 0
-                for row_idx, row_data in enumerate(header_details, start=dataCellStart):
-                    if len(str(row_data[col_idx - 1])) > max_length:
-                        max_length = len(str(row_data[col_idx - 1]))
-
-                # Set column width (slightly larger to accommodate characters)
-                adjusted_width = max_length + 4  # Add some padding for better spacing
-                cover_ws.column_dimensions[
-                    chr(64 + col_idx)].width = adjusted_width  # chr(64 + col_idx) converts to 'A', 'B', 'C'
-
-            data_color = PatternFill(start_color="FFEBD6", end_color="FFEBD6", fill_type="solid")
-            for row in cover_ws.iter_rows(min_row=dataCellStart, max_row=dataCellEnd - 1, min_col=1, max_col=8):
-                for cell in row:
-                    cell.border = thin_border
-                    cell.fill = data_color
-
-            for col in df.columns:
-                if isinstance(df[col], pd.Series):
-                    try:
-                        if pd.api.types.is_numeric_dtype(df[col]):
-                            continue  # Already numeric, no need to convert
-                        df[col] = pd.to_numeric(df[col])
-                    except ValueError:
-                        logging.warning(f"Skipping non-numeric column: {col}")
-                        continue
-                else:
-                    logging.warning(f"Skipping column {col} as it is not a valid Series")
-
-            date_style = NamedStyle(name="date", number_format='DD/MM/YYYY')
-            datetime_style = NamedStyle(name="datetime", number_format='DD/MM/YYYY HH:MM:SS')
-
-            # Split data into chunks of 10,000 rows
-            for chunk_num, chunk in enumerate(range(0, len(df), 10000)):
-                sheet_name = f"Sheet{chunk_num + 1}"
-                df_chunk = df.iloc[chunk:chunk + 10000]
-                df_chunk.to_excel(writer, sheet_name=sheet_name, index=False)
-
-                # Open the workbook to format the header
-                ws = wb[sheet_name]
-
-                # Set header style (font size 12, yellow fill)
-                for cell in ws[1]:
-                    cell.font = Font(size=12, bold=True)
-                    cell.fill = PatternFill(start_color="f5f6f9", end_color="f5f6f9", fill_type="solid")
-                ws.auto_filter.ref = ws.dimensions
-
-                # Identify columns that should be hyperlinks based on header names
-                link_header_row = [cell.value for cell in ws[1]]
-                hyperlink_columns = [link_header_row.index(header) + 1 for header in hyperlink_headers if
-                                     header in link_header_row]
-
-                for col_idx in hyperlink_columns:
-                    for row in range(2, len(df_chunk) + 2):  # Skip header row, starting from row 2
-                        cell_value = df_chunk.iloc[row - 2, col_idx - 1]
-                        if pd.notna(cell_value):
-                            cell = ws.cell(row=row, column=col_idx, value=cell_value)  # Set the display text
-                            cell.hyperlink = cell_value  # Set the URL as the hyperlink
-                            cell.style = "Hyperlink"
-
-                date_header_row = [cell.value for cell in ws[1]]
-                date_columns = [date_header_row.index(header) + 1 for header in date_headers if
-                                header in date_header_row]
-
-                for col_idx in date_columns:
-                    for row in range(2, len(df_chunk) + 2):  # Skip header row, starting from row 2
-                        cell_value = df_chunk.iloc[row - 2, col_idx - 1]
-                        if pd.notna(cell_value):
-                            date_value, format_used = try_convert_to_date(cell_value)
-                            cell = ws.cell(row=row, column=col_idx,
-                                           value=cell_value)  # Keep original value if not converted
-                            if date_value:
-                                cell.value = date_value
-                                # Apply datetime format if time is included, otherwise apply date format
-                                if "%H:%M" in format_used or "%H:%M:%S" in format_used:
-                                    cell.style = datetime_style
-                                else:
-                                    cell.style = date_style
-
-        return True
+        # Split data into chunks of 10,000 rows
+        for chunk_num, df_chunk in enumerate(rechunkBatches(batches, SHEET_ROWS)):
+            total_records += len(df_chunk)
+            ws = wb.create_sheet(title=f"Sheet{chunk_num + 1}")
+            writeDataSheet(ws, df_chunk, hyperlink_headers, date_headers, date_formats, date_styles)
+
+        wb.save(filename)
+        return total_records
     except Exception as e:
         logging.info("Exception happened in the xlsxWriter: " + str(e))
-        return False
+        return None
 
 
-def getData(tablename, wsname, columnDefs, columnMapping, schemaName, createdbyId):
+def getCoverFilename(filename):
+    for extension in OUTPUT_EXTENSIONS.values():
+        if filename.endswith(extension):
+            return filename[:-len(extension)] + "_cover.csv"
+    return filename + "_cover.csv"
+
+
+def writeCoverSidecar(filename, schemaName, header_details, createdbyId):
+    # csv.gz and parquet have no cover sheet, the same details go to a small csv next to the report
+    current_time_ist = datetime.now(ist)
+    cover_rows = [
+        [schemaName],
+        ["Created On", current_time_ist.strftime("%d/%m/%Y"), "Created By", getCreatedBy(createdbyId)],
+        [],
+        ["Column Name", "Data Type", "Agg Type", "Agg Value", "Group Name", "UI Format Type", "Grouping", "Pivot"],
+    ]
+    with open(getCoverFilename(filename), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerows(cover_rows + header_details)
+
+
+def csvWriter(filename, schemaName, header_details, createdbyId, batches):
     try:
-        logging.info("getData called...")
-        filename = '_'.join(wsname) + "_" + str(currtime) + ".xlsx"
+        writeCoverSidecar(filename, schemaName, header_details, createdbyId)
         total_records = 0
+        with gzip.open(filename, 'wt', encoding='utf-8', newline='') as f:
+            for batch in batches:
+                batch.to_csv(f, index=False, header=(total_records == 0))
+                total_records += len(batch)
+        return total_records
+    except Exception as e:
+        logging.info("Exception happened in the csvWriter: " + str(e))
+        return None
+
+
+def getArrowType(type_oid):
+    import pyarrow as pa
+
+    if type_oid == BOOL_TYPE_OID:
+        return pa.bool_()
+    if type_oid in INTEGER_TYPE_OIDS:
+        return pa.int64()
+    if type_oid in NUMERIC_TYPE_OIDS and type_oid != MONEY_TYPE_OID:
+        return pa.float64()
+    if type_oid == DATE_TYPE_OID:
+        return pa.date32()
+    if type_oid == TIMESTAMP_TYPE_OID:
+        return pa.timestamp("us")
+    if type_oid == TIMESTAMPTZ_TYPE_OID:
+        return pa.timestamp("us", tz="UTC")
+    # money, text and everything else is written as text
+    return pa.string()
+
+
+def castParquetBatch(batch, schema):
+    import pyarrow as pa
+
+    for field in schema:
+        values = batch[field.name]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Categories differ between batches, plain values keep one schema for the whole file
+            values = values.astype(object)
+        if pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+            # numeric arrives as Decimal from the cursor path
+            values = pd.to_numeric(values)
+        elif pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(values, utc=field.type.tz is not None)
+        elif pa.types.is_string(field.type):
+            values = values.astype(object)
+            values = values.where(values.isna(), values.astype(str))
+        batch[field.name] = values
+    return pa.Table.from_pandas(batch, schema=schema, preserve_index=False)
+
+
+def parquetWriter(filename, schemaName, header_details, createdbyId, batches, result_types):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writeCoverSidecar(filename, schemaName, header_details, createdbyId)
+        total_records = 0
+        writer = None
+        try:
+            for batch in batches:
+                if writer is None:
+                    # Typed from the result columns, not from the first batch, so a column that is empty or
+                    # narrower there still takes the values of later batches
+                    schema = pa.schema([(col, getArrowType(result_types.get(col))) for col in batch.columns])
+                    writer = pq.ParquetWriter(filename, schema)
+                writer.write_table(castParquetBatch(batch, schema))
+                total_records += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        return total_records
+    except Exception as e:
+        logging.info("Exception happened in the parquetWriter: " + str(e))
+        return None
+
+
+def getWorkspaceCondition(wsname):
+    # Any admin workspace exports the whole table
+    for i in range(len(wsname)):
+        if "admin" in wsname[i].lower():
+            return "", None
+    return " WHERE \"Workspace\" ILIKE ANY(%s)", (list(wsname),)
+
+
+def getResultColumnTypes(tablename, column_query):
+    with pgconn.cursor() as cursor:
+        # Column types only, no rows are read
+        cursor.execute(f"SELECT {column_query} FROM {tablename} LIMIT 0")
+        return {desc[0]: desc[1] for desc in cursor.description}
+
+
+def getCoverAggregates(tablename, wsname, column_query, header_details_map):
+    logging.info("getCoverAggregates called...")
+    workspace_condition, params = getWorkspaceCondition(wsname)
+    report_query = f"SELECT {column_query} FROM {tablename}{workspace_condition}"
+    # Used to decide whether SUM needs a guarded cast
+    column_types = getResultColumnTypes(tablename, column_query)
+    with pgconn.cursor() as cursor:
+
+        agg_keys = []
+        agg_columns = []
+        for key, val in header_details_map.items():
+            column = sql.Identifier(key).as_string(pgconn)
+            if val[2] == "SUM":
+                if column_types.get(key) in NUMERIC_TYPE_OIDS:
+                    agg_columns.append(f'COALESCE(SUM(report.{column}), 0)')
+                else:
+                    agg_columns.append(f'COALESCE(SUM(CASE WHEN report.{column}::text ~ \'{NUMERIC_TEXT_PATTERN}\' '
+                                       f'THEN report.{column}::text::numeric END), 0)')
+            elif val[2] == "UNIQUE COUNT":
+                agg_columns.append(f'COUNT(DISTINCT report.{column})')
+            else:
+                continue
+            agg_keys.append(key)
+
+        # The row count comes along so the output format can be picked before writing
+        agg_columns.append("COUNT(*)")
+        select_query = f"SELECT {', '.join(agg_columns)} FROM ({report_query}) AS report"
+        logging.info("Query: " + str(select_query))
+        cursor.execute(select_query, params)
+        row = cursor.fetchone()
+        aggregates = {}
+        for i in range(len(agg_keys)):
+            aggregates[agg_keys[i]] = row[i]
+        record_count = row[-1]
+
+    header_details = []
+    for key, val in header_details_map.items():
+        header_details.append([key, val[1], val[2], aggregates.get(key, 0), val[3], val[4], val[5], val[6]])
+    return header_details, record_count
+
+
+def getColumnTypes(header_details_map):
+    # Dtype plan from the AG_TABLE_SCHEMA columnMapping data types of the exported columns
+    column_types = {}
+    for key, val in header_details_map.items():
+        if val[1] == "NUMBER":
+            column_types[key] = "number"
+        elif val[1] == "DATE":
+            column_types[key] = "date"
+        else:
+            column_types[key] = "text"
+    return column_types
+
+
+def applyColumnTypes(df, column_types):
+    for col, column_type in column_types.items():
+        if col not in df.columns or not isinstance(df[col], pd.Series):
+            continue
+        if column_type == "number":
+            if pd.api.types.is_numeric_dtype(df[col]):
+                continue  # Already numeric, no need to convert
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except (ValueError, TypeError):
+                logging.warning(f"Column {col} is mapped as NUMBER but has non-numeric values")
+        elif column_type == "text" and (pd.api.types.is_object_dtype(df[col]) or
+                                        pd.api.types.is_string_dtype(df[col])):
+            # Repetitive text such as workspace or vendor names is stored once per distinct value
+            if df[col].nunique() <= len(df) * CATEGORY_MAX_RATIO:
+                df[col] = df[col].astype("category")
+        # Date columns are converted by normalizeDateColumn when the sheet is written
+    return df
+
+
+def getTablePartitions(tablename, partitions):
+    logging.info("getTablePartitions called...")
+    try:
+        with pgconn.cursor() as cursor:
+            # Views and empty tables have no blocks and are read in a single pass
+            cursor.execute("SELECT pg_relation_size(%s::regclass) / current_setting('block_size')::int",
+                           (tablename,))
+            blocks = cursor.fetchone()[0]
+    except Exception as e:
+        logging.info("Exception happened in getTablePartitions: " + str(e))
+        pgconn.rollback()
+        return []
+    if blocks is None or blocks < partitions:
+        return []
+    step = -(-blocks // partitions)
+    ranges = []
+    for start in range(0, blocks, step):
+        # The last range is left open so pages added since the size check are still read
+        end = start + step if start + step < blocks else None
+        ranges.append((start, end))
+    return ranges
+
+
+def putUntilStopped(out_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            out_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def fetchPartition(select_query, snapshot_id, column_types, out_queue, stop_event):
+    conn = None
+    try:
+        conn = connectPostgres()
+        if snapshot_id is not None:
+            conn.set_session(isolation_level='REPEATABLE READ')
+        with conn.cursor() as cursor:
+            if snapshot_id is not None:
+                # Every partition reads the same snapshot as the main connection
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+        with conn.cursor(name="recon_report_partition") as cursor:
+            cursor.itersize = PG_ITERSIZE
+            cursor.execute(select_query)
+            column_names = None
+            while not stop_event.is_set():
+                results = cursor.fetchmany(BATCH_SIZE)
+                if len(results) == 0:
+                    break
+                if column_names is None:
+                    column_names = [desc[0] for desc in cursor.description]
+                putUntilStopped(out_queue, applyColumnTypes(pd.DataFrame(results, columns=column_names),
+                                                            column_types), stop_event)
+        putUntilStopped(out_queue, None, stop_event)
+    except Exception as e:
+        putUntilStopped(out_queue, e, stop_event)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def fetchPartitionedBatches(tablename, column_query, column_types, partitions):
+    logging.info("fetchPartitionedBatches called...")
+    snapshot_id = None
+    try:
+        with pgconn.cursor() as cursor:
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot_id = cursor.fetchone()[0]
+    except Exception as e:
+        logging.info("Snapshot export failed, partitions read their own snapshot: " + str(e))
+        pgconn.rollback()
+
+    stop_event = threading.Event()
+    queues = []
+    threads = []
+    for start, end in partitions:
+        block_condition = f"ctid >= '({start},0)'::tid"
+        if end is not None:
+            block_condition += f" AND ctid < '({end},0)'::tid"
+        select_query = f"SELECT {column_query} FROM {tablename} WHERE {block_condition}"
+        logging.info("Query: " + str(select_query))
+        out_queue = queue.Queue(maxsize=PARTITION_PREFETCH)
+        thread = threading.Thread(target=fetchPartition,
+                                  args=(select_query, snapshot_id, column_types, out_queue, stop_event),
+                                  daemon=True)
+        queues.append(out_queue)
+        threads.append(thread)
+        thread.start()
+
+    try:
+        # Partitions are handed to the writer in block order, later ones prefetch meanwhile
+        record_count = 0
+        for out_queue in queues:
+            while True:
+                item = out_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                record_count += len(item)
+                yield item
+        logging.info("No. of record: " + str(record_count))
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+
+def estimateRowCount(select_query, params):
+    logging.info("estimateRowCount called...")
+    with pgconn.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + select_query, params)
+        plan = cursor.fetchone()[0]
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+def parseCopyColumns(batch, copy_types):
+    # COPY sends every value as text, columns are parsed back to the types the cursor path gets from psycopg2
+    for col, type_oid in copy_types.items():
+        if col not in batch.columns or not isinstance(batch[col], pd.Series):
+            continue
+        try:
+            if type_oid == BOOL_TYPE_OID:
+                batch[col] = batch[col].map({"t": True, "f": False})
+            elif type_oid in NUMERIC_TYPE_OIDS and type_oid != MONEY_TYPE_OID:
+                batch[col] = pd.to_numeric(batch[col])
+            elif type_oid == DATE_TYPE_OID:
+                batch[col] = pd.to_datetime(batch[col], format="%Y-%m-%d").dt.date
+            elif type_oid in TIMESTAMP_TYPE_OIDS:
+                try:
+                    batch[col] = pd.to_datetime(batch[col], format="ISO8601")
+                except ValueError:
+                    # timestamptz values with different UTC offsets, e.g. across a DST change
+                    batch[col] = pd.to_datetime(batch[col], format="ISO8601", utc=True)
+        except (ValueError, TypeError, OverflowError) as e:
+            logging.warning(f"Column {col} is kept as text: " + str(e))
+    return batch
+
+
+def fetchCopyBatches(select_query, params, column_types):
+    logging.info("fetchCopyBatches called...")
+    # COPY holds its connection until the stream ends, so it gets its own and pgconn stays free for the aggregates
+    conn = connectPostgres()
+    try:
+        with conn.cursor() as cursor:
+            # Column types only, COPY itself carries none
+            cursor.execute(f"SELECT * FROM ({select_query}) AS report LIMIT 0", params)
+            copy_types = {desc[0]: desc[1] for desc in cursor.description}
+            copy_query = "COPY (" + cursor.mogrify(select_query, params).decode() + ") TO STDOUT WITH CSV HEADER"
+    except Exception:
+        # Pool processes are long lived, a failed type probe must not leave its backend open
+        conn.close()
+        raise
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def copyToPipe():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe_out:
+                with conn.cursor() as cursor:
+                    cursor.copy_expert(copy_query, pipe_out)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=copyToPipe, daemon=True)
+    thread.start()
+    try:
+        # Read as text so codes keep their leading zeros, parseCopyColumns types the rest from the result columns
+        record_count = 0
+        with os.fdopen(read_fd, 'rb') as pipe_in:
+            try:
+                reader = pd.read_csv(pipe_in, chunksize=BATCH_SIZE, dtype=str, keep_default_na=False,
+                                     na_values=[""])
+            except pd.errors.EmptyDataError:
+                # Not even a header came through, the COPY failed and its error is raised below
+                reader = []
+            for batch in reader:
+                if len(batch) == 0:
+                    # A header without rows, an empty result yields no batch just like the cursor path
+                    continue
+                record_count += len(batch)
+                yield applyColumnTypes(parseCopyColumns(batch, copy_types), column_types)
+        logging.info("No. of record: " + str(record_count))
+    finally:
+        thread.join()
+        conn.close()
+    if len(errors) != 0:
+        raise errors[0]
+
+
+def fetchRecordBatches(tablename, wsname, column_query, column_types):
+    logging.info("fetchRecordBatches called...")
+    # One query covers every workspace of the job, admin workspaces read the whole table
+    workspace_condition, params = getWorkspaceCondition(wsname)
+    if workspace_condition == "" and EXTRACT_PARTITIONS > 1:
+        partitions = getTablePartitions(tablename, EXTRACT_PARTITIONS)
+        if len(partitions) > 1:
+            yield from fetchPartitionedBatches(tablename, column_query, column_types, partitions)
+            return
+
+    select_query = f"SELECT {column_query} FROM {tablename}{workspace_condition}"
+
+    logging.info("Query: " + str(select_query))
+    logging.info("Param: " + str(params))
+    backend = EXTRACT_BACKEND
+    if backend == "auto":
+        try:
+            estimated_rows = estimateRowCount(select_query, params)
+            logging.info("Estimated no. of record: " + str(estimated_rows))
+            backend = "copy" if estimated_rows >= COPY_ROW_THRESHOLD else "cursor"
+        except Exception as e:
+            logging.info("Exception happened in estimateRowCount: " + str(e))
+            pgconn.rollback()
+            backend = "cursor"
+    if backend == "copy":
+        yield from fetchCopyBatches(select_query, params, column_types)
+        return
+
+    # Named cursor keeps the result set on the server, rows are pulled itersize at a time
+    with pgconn.cursor(name="recon_report_" + str(currtime)) as cursor:
+        cursor.itersize = PG_ITERSIZE
+        cursor.execute(select_query, params)
+        record_count = 0
+        column_names = None
+        while True:
+            results = cursor.fetchmany(BATCH_SIZE)
+            if len(results) == 0:
+                break
+            if column_names is None:
+                column_names = [desc[0] for desc in cursor.description]
+            record_count += len(results)
+            yield applyColumnTypes(pd.DataFrame(results, columns=column_names), column_types)
+        logging.info("No. of record: " + str(record_count))
+
+
+def getData(tablename, wsname, columnDefs, columnMapping, schemaName, createdbyId, outputFormat="xlsx", lease=None):
+    try:
+        logging.info("getData called...")
+        if outputFormat not in OUTPUT_EXTENSIONS:
+            logging.info("Unknown output format " + str(outputFormat) + ", writing xlsx")
+            outputFormat = "xlsx"
+        tablename = getTableIdentifier(tablename).as_string(pgconn)
         column_query = ""
-        header_details = []
         columnMap = {}
         hyperlink_headers = []
         date_columns = []
@@ -370,8 +1058,8 @@ def getData(tablename, wsname, columnDefs, columnMapping, schemaName, createdbyI
         for i in range(len(columnDefs)):
             columnadded = False
             if "hide" in columnDefs[i] and columnDefs[i]["hide"] == False:
-                column_query = column_query + '"' + columnDefs[i]["field"] + '" AS "' + columnDefs[i][
-                    "headerName"] + '"'
+                column_query += sql.SQL("{} AS {}").format(sql.Identifier(columnDefs[i]["field"]), sql.Identifier(
+                    columnDefs[i]["headerName"])).as_string(pgconn)
                 column_details = columnMap.get(columnDefs[i]["field"])
                 columnadded = True
                 uiFormatType = ""
@@ -403,8 +1091,9 @@ def getData(tablename, wsname, columnDefs, columnMapping, schemaName, createdbyI
                 for j in range(len(columnDefs[i]["children"])):
                     columnadded = False
                     if "hide" in columnDefs[i]["children"][j] and columnDefs[i]["children"][j]["hide"] == False:
-                        column_query = column_query + '"' + columnDefs[i]["children"][j]["field"] + '" AS "' + \
-                                       columnDefs[i]["children"][j]["headerName"] + '"'
+                        column_query += sql.SQL("{} AS {}").format(
+                            sql.Identifier(columnDefs[i]["children"][j]["field"]),
+                            sql.Identifier(columnDefs[i]["children"][j]["headerName"])).as_string(pgconn)
                         column_details = columnMap.get(columnDefs[i]["children"][j]["field"])
                         columnadded = True
                         uiFormatType = ""
@@ -446,56 +1135,53 @@ def getData(tablename, wsname, columnDefs, columnMapping, schemaName, createdbyI
         elif column_query.endswith(","):
             column_query = column_query[:-1]
 
-        df = None
-        for i in range(len(wsname)):
-            with pgconn.cursor() as cursor:
-                if "admin" in wsname[i].lower():
-                    select_query = f"SELECT {column_query} FROM {tablename}"
-                else:
-                    select_query = f"SELECT {column_query} FROM {tablename} WHERE \"Workspace\" ILIKE %s"
-
-                logging.info("Query: " + str(select_query))
-                logging.info("Param: " + str(wsname[i]))
-                cursor.execute(select_query, (wsname[i],))
-                results = cursor.fetchall()
-                if results is None or len(results) == 0:
-                    continue
-                logging.info("No. of record: " + str(len(results)))
-                column_names = [desc[0] for desc in cursor.description]
-            df_temp = pd.DataFrame(results, columns=column_names)
-            df = pd.concat([df, df_temp], ignore_index=True)
-
-        if df is None:
+        column_types = getColumnTypes(header_details_map)
+        for key, column_type in column_types.items():
+            if column_type == "date" and key not in date_columns:
+                date_columns.append(key)
+        for key in date_columns:
+            column_types[key] = "date"
+
+        batches = fetchRecordBatches(tablename, wsname, column_query, column_types)
+        if lease is not None:
+            batches = lease.checked(batches)
+        first_batch = next(batches, None)
+        if first_batch is None:
             return None,0,None
-
-        for key, val in header_details_map.items():
-            count = 0
-            if val[2] == "SUM":
-                count = df[str(key)].sum()
-            elif val[2] == "UNIQUE COUNT":
-                count = df[str(key)].nunique()
-            header_details.append([key, val[1], val[2], count, val[3], val[4], val[5], val[6]])
-
-        if df is not None and len(df) != 0:
-            total_records += len(df)
-            status = xlsxWriter(filename, schemaName, header_details, hyperlink_headers, date_columns, createdbyId, df)
-            if not status:
-                return None, None, None
+        header_details, report_count = getCoverAggregates(tablename, wsname, column_query, header_details_map)
+        if outputFormat == "xlsx" and report_count > XLSX_MAX_ROWS:
+            logging.info("No. of record " + str(report_count) + " is above the xlsx limit, writing csv.gz")
+            outputFormat = "csv.gz"
+
+        filename = '_'.join(wsname) + "_" + str(currtime) + OUTPUT_EXTENSIONS[outputFormat]
+        batches = itertools.chain([first_batch], batches)
+        if outputFormat == "csv.gz":
+            total_records = csvWriter(filename, schemaName, header_details, createdbyId, batches)
+        elif outputFormat == "parquet":
+            total_records = parquetWriter(filename, schemaName, header_details, createdbyId, batches,
+                                          getResultColumnTypes(tablename, column_query))
+        else:
+            total_records = xlsxWriter(filename, schemaName, header_details, hyperlink_headers, date_columns,
+                                       createdbyId, batches)
+        if total_records is None:
+            return None, None, None
         filehash = findFileHash(filename)
         logging.info(f"Total records written: {total_records}")
         return filename, total_records, filehash
     except Exception as e:
         logging.info("Exception happened in the getData: " + str(e))
+        pgconn.rollback()
         return None, None, None
 
 
 def getWorkspaceName(workspaceids):
     logging.info("getWorkspaceName called...")
     finalresult = []
-    workspaceids = tuple(workspaceids)
+    workspaceids = list(workspaceids)
     with pgconn.cursor() as cursor:
-        select_query = "SELECT name FROM workspaces WHERE id in %s"
-        cursor.execute(select_query, (workspaceids,))
+        select_query = "SELECT name FROM workspaces WHERE id = ANY($1::uuid[])"
+        # workspaces.id is a uuid, the ids arrive as text[] and are cast in the query
+        executePrepared(cursor, "recon_workspace_names", select_query, (workspaceids,), ("text[]",))
         results = cursor.fetchall()
         for row in results:
             finalresult.append(row[0])
@@ -504,18 +1190,13 @@ def getWorkspaceName(workspaceids):
 
 def removeFile(filename):
     logging.info("removeFile called...")
+    if filename is None:
+        return
     if os.path.exists(filename):
         os.remove(filename)
-
-
-def getPendingJob():
-    logging.info("getPendingJob called...")
-    db = client['gstservice']
-    collection = db['recon_report']
-    # result = list(collection.find({"reportId": "414687f1-1aa5-4cdd-9166-8ebae1cfad7d"}).limit(LIMIT))
-    # result = list(collection.find({"reportId": "514c176d-fddb-4c5b-ac2d-b51770635c64"}).limit(LIMIT))
-    result = list(collection.find({"status": "PENDING"}).sort({"createdBy": -1}).limit(LIMIT))
-    return result
+    cover_filename = getCoverFilename(filename)
+    if os.path.exists(cover_filename):
+        os.remove(cover_filename)
 
 
 def getSchema(moduleId):
@@ -526,169 +1207,199 @@ def getSchema(moduleId):
     return result
 
 
-if __name__ == '__main__':
+def processJob(job, jobtime):
+    global currtime, bucket_time
+    currtime, bucket_time = getJobTimes(jobtime)
+    runLeasedJob(collection, job, runJob, finishJob=rollbackPgconn)
+
+
+def rollbackPgconn():
+    # The pool process runs its next job on the same pgconn, no transaction may stay open or aborted
     try:
-        me = singleton.SingleInstance()
-        logging.info("======================================================")
-        jobs = getPendingJob()
-
-        db = client['gstservice']
-        collection = db['recon_report']
-
-        if jobs is not None and len(jobs) != 0:
-            for i in range(len(jobs)):
-                logging.info("Processing for job: " + str(jobs[i]))
-                if "workspace_id" in jobs[i] and "table_name" in jobs[i]:
-                    workspacename = getWorkspaceName(jobs[i]['workspace_id'])
-                    logging.info("Workspace Names: " + str(workspacename))
-                    if workspacename is not None and len(workspacename) != 0:
-                        schemaDetails = getSchema(jobs[i]["moduleId"])
-                        logging.info("Schema Details: " + str(schemaDetails))
-                        if schemaDetails is None:
-                            key_to_check = {"_id": jobs[i]["_id"]}
-                            result = collection.update_one(
-                                key_to_check,
-                                {
-                                    "$set": {
-                                        "status": "SCHEMA DETAILS MISSING",
-                                        "total_record": 0
-                                    }
-                                })
-                            if result.matched_count > 0:
-                                logging.info("Updated the document: " + str(key_to_check))
-                            else:
-                                logging.info("No updates for the document: " + str(key_to_check))
-                            continue
-
-                        filename, count, filehash = getData(jobs[i]['table_name'], workspacename,
-                                                            schemaDetails["state"]["columnDefs"],
-                                                            schemaDetails["state"]["columnMapping"],
-                                                            schemaDetails["name"], jobs[i]["createdBy"])
-                        logging.info("Filename: " + str(filename))
-                        logging.info("Total no. of records: " + str(count))
-                        if count is None:
-                            key_to_check = {"_id": jobs[i]["_id"]}
-                            result = collection.update_one(
-                                key_to_check,
-                                {
-                                    "$set": {
-                                        "status": "EXCEPTION IN GETDATA",
-                                        "total_record": 0
-                                    }
-                                })
-                            if result.matched_count > 0:
-                                logging.info("Updated the document: " + str(key_to_check))
-                            else:
-                                logging.info("No updates for the document: " + str(key_to_check))
-
-                        elif count != 0:
-                            s3_url = uploadFile(filename)
-                            logging.info("S3 URL: " + str(s3_url))
-                            if s3_url is not None:
-                                subject = ""
-                                if "report_name" in jobs[i]:
-                                    subject = subject + str(jobs[i]["report_name"]) + " is ready to download"
-                                else:
-                                    subject = "Report ready to download"
-
-                                dynamic_template_data = {
-                                    "subject": subject,
-                                    "description": "As per your request we have generated this report of your workspace.",
-                                    "download_link": "https://files.finkraft.ai/report-" + str(filehash),
-                                }
-                                template_id = "d-a6a5853662824aa7a69e990013cf1faa"
-                                to_emails = []
-                                if "to_emails" in jobs[i]:
-                                    to_emails = jobs[i]["to_emails"]
-                                if len(to_emails) != 0:
-                                    sendMailToClient(to_emails, template_id, dynamic_template_data)
-                                    key_to_check = {"_id": jobs[i]["_id"]}
-                                    result = collection.update_one(
-                                        key_to_check,
-                                        {
-                                            "$set": {
-                                                "status": "COMPLETED",
-                                                "link": s3_url,
-                                                "total_record": count,
-                                                "filehash": filehash
-                                            }
-                                        })
-                                    if result.matched_count > 0:
-                                        logging.info("Updated the document: " + str(key_to_check))
-                                    else:
-                                        logging.info("No updates for the document: " + str(key_to_check))
-                                else:
-                                    key_to_check = {"_id": jobs[i]["_id"]}
-                                    result = collection.update_one(
-                                        key_to_check,
-                                        {
-                                            "$set": {
-                                                "status": "TO MAIL MISSING",
-                                                "total_record": count
-                                            }
-                                        })
-                                    if result.matched_count > 0:
-                                        logging.info("Updated the document: " + str(key_to_check))
-                                    else:
-                                        logging.info("No updates for the document: " + str(key_to_check))
-                            else:
-                                key_to_check = {"_id": jobs[i]["_id"]}
-                                result = collection.update_one(
-                                    key_to_check,
-                                    {
-                                        "$set": {
-                                            "status": "FAILED TO GENERATE LINK",
-                                            "total_record": count
-                                        }
-                                    })
-                                if result.matched_count > 0:
-                                    logging.info("Updated the document: " + str(key_to_check))
-                                else:
-                                    logging.info("No updates for the document: " + str(key_to_check))
-                        elif count == 0:
-                            key_to_check = {"_id": jobs[i]["_id"]}
-                            result = collection.update_one(
-                                key_to_check,
-                                {
-                                    "$set": {
-                                        "status": "COMPLETED",
-                                        "total_record": count
-                                    }
-                                })
-                            if result.matched_count > 0:
-                                logging.info("Updated the document: " + str(key_to_check))
-                            else:
-                                logging.info("No updates for the document: " + str(key_to_check))
-
-                        removeFile(filename)
-                    else:
-                        key_to_check = {"_id": jobs[i]["_id"]}
-                        result = collection.update_one(
-                            key_to_check,
-                            {
-                                "$set": {
-                                    "status": "WORKSPACE NOT FOUND"
-                                }
-                            })
-                        if result.matched_count > 0:
-                            logging.info("Updated the document: " + str(key_to_check))
-                        else:
-                            logging.info("No updates for the document: " + str(key_to_check))
+        pgconn.rollback()
+    except Exception as e:
+        logging.info("Exception happened in rollback: " + str(e))
+
+
+def deliverReport(job, lease, filename, count, filehash):
+    # A job lost while its data was extracted stops here instead of writing a status
+    lease.check()
+    logging.info("Filename: " + str(filename))
+    logging.info("Total no. of records: " + str(count))
+    if count is None:
+        key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+        result = collection.update_one(
+            key_to_check,
+            {
+                "$set": {
+                    "status": "EXCEPTION IN GETDATA",
+                    "total_record": 0
+                }
+            })
+        if result.matched_count > 0:
+            logging.info("Updated the document: " + str(key_to_check))
+        else:
+            logging.info("No updates for the document: " + str(key_to_check))
+
+    elif count != 0:
+        # Only the owner of the job overwrites the report in S3, a worker that lost it stops here
+        lease.transition("IN PROGRESS", "FINALIZING")
+        s3_url = uploadFile(filename)
+        logging.info("S3 URL: " + str(s3_url))
+        cover_url = None
+        if os.path.exists(getCoverFilename(filename)):
+            cover_url = uploadFile(getCoverFilename(filename))
+            logging.info("Cover S3 URL: " + str(cover_url))
+        if s3_url is not None:
+            subject = ""
+            if "report_name" in job:
+                subject = subject + str(job["report_name"]) + " is ready to download"
+            else:
+                subject = "Report ready to download"
+
+            dynamic_template_data = {
+                "subject": subject,
+                "description": "As per your request we have generated this report of your workspace.",
+                "download_link": "https://files.finkraft.ai/report-" + str(filehash),
+            }
+            template_id = "d-a6a5853662824aa7a69e990013cf1faa"
+            to_emails = []
+            if "to_emails" in job:
+                to_emails = job["to_emails"]
+            if len(to_emails) != 0:
+                lease.confirm()
+                sendMailToClient(to_emails, template_id, dynamic_template_data)
+                key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+                result = collection.update_one(
+                    key_to_check,
+                    {
+                        "$set": {
+                            "status": "COMPLETED",
+                            "link": s3_url,
+                            "cover_link": cover_url,
+                            "total_record": count,
+                            "filehash": filehash
+                        }
+                    })
+                if result.matched_count > 0:
+                    logging.info("Updated the document: " + str(key_to_check))
+                else:
+                    logging.info("No updates for the document: " + str(key_to_check))
+            else:
+                key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+                result = collection.update_one(
+                    key_to_check,
+                    {
+                        "$set": {
+                            "status": "TO MAIL MISSING",
+                            "total_record": count
+                        }
+                    })
+                if result.matched_count > 0:
+                    logging.info("Updated the document: " + str(key_to_check))
+                else:
+                    logging.info("No updates for the document: " + str(key_to_check))
+        else:
+            key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+            result = collection.update_one(
+                key_to_check,
+                {
+                    "$set": {
+                        "status": "FAILED TO GENERATE LINK",
+                        "total_record": count
+                    }
+                })
+            if result.matched_count > 0:
+                logging.info("Updated the document: " + str(key_to_check))
+            else:
+                logging.info("No updates for the document: " + str(key_to_check))
+    elif count == 0:
+        key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+        result = collection.update_one(
+            key_to_check,
+            {
+                "$set": {
+                    "status": "COMPLETED",
+                    "total_record": count
+                }
+            })
+        if result.matched_count > 0:
+            logging.info("Updated the document: " + str(key_to_check))
+        else:
+            logging.info("No updates for the document: " + str(key_to_check))
+
+
+def runJob(job, lease):
+    if "workspace_id" in job and "table_name" in job:
+        workspacename = getWorkspaceName(job['workspace_id'])
+        logging.info("Workspace Names: " + str(workspacename))
+        if workspacename is not None and len(workspacename) != 0:
+            schemaDetails = getSchema(job["moduleId"])
+            logging.info("Schema Details: " + str(schemaDetails))
+            if schemaDetails is None:
+                key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+                result = collection.update_one(
+                    key_to_check,
+                    {
+                        "$set": {
+                            "status": "SCHEMA DETAILS MISSING",
+                            "total_record": 0
+                        }
+                    })
+                if result.matched_count > 0:
+                    logging.info("Updated the document: " + str(key_to_check))
                 else:
-                    key_to_check = {"_id": jobs[i]["_id"]}
-                    result = collection.update_one(
-                        key_to_check,
-                        {
-                            "$set": {
-                                "status": "WORKSPACE ID OR TABLE NAME MISSING"
-                            }
-                        })
-                    if result.matched_count > 0:
-                        logging.info("Updated the document: " + str(key_to_check))
-                    else:
-                        logging.info("No updates for the document: " + str(key_to_check))
+                    logging.info("No updates for the document: " + str(key_to_check))
+                return
+
+            outputFormat = "xlsx"
+            if "output_format" in job:
+                outputFormat = job["output_format"]
+            filename, count, filehash = getData(job['table_name'], workspacename,
+                                                schemaDetails["state"]["columnDefs"],
+                                                schemaDetails["state"]["columnMapping"],
+                                                schemaDetails["name"], job["createdBy"],
+                                                outputFormat, lease)
+            try:
+                deliverReport(job, lease, filename, count, filehash)
+            finally:
+                removeFile(filename)
+        else:
+            key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+            result = collection.update_one(
+                key_to_check,
+                {
+                    "$set": {
+                        "status": "WORKSPACE NOT FOUND"
+                    }
+                })
+            if result.matched_count > 0:
+                logging.info("Updated the document: " + str(key_to_check))
+            else:
+                logging.info("No updates for the document: " + str(key_to_check))
+    else:
+        key_to_check = {"_id": job["_id"], "workerId": job["workerId"]}
+        result = collection.update_one(
+            key_to_check,
+            {
+                "$set": {
+                    "status": "WORKSPACE ID OR TABLE NAME MISSING"
+                }
+            })
+        if result.matched_count > 0:
+            logging.info("Updated the document: " + str(key_to_check))
+        else:
+            logging.info("No updates for the document: " + str(key_to_check))
+
+
+if __name__ == '__main__':
+    try:
+        host_slot = acquireHostSlot("send-report")
+        if host_slot is None:
+            logging.info("MAX_WORKERS_PER_HOST workers already running on this host")
         else:
-            logging.info("No pending jobs")
-        logging.info("======================================================")
+            logging.info("======================================================")
+            runWorker(collection, {}, processJob, WORKER_CONCURRENCY)
+            logging.info("======================================================")
     except Exception as e:
         logging.info("Exception happened in the main: " + str(e))
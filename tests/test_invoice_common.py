@@ -0,0 +1,107 @@
+import base64
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import invoice_common  # noqa: E402
+
+
+def writeBlob(path, size, age):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as blob:
+        blob.write(b"x" * size)
+    used = time.time() - age
+    os.utime(path, (used, used))
+    return path
+
+
+def testEvictBlobCacheEnforcesTheBudget(monkeypatch, tmp_path):
+    monkeypatch.setattr(invoice_common, "BLOB_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(invoice_common, "BLOB_CACHE_MAX_BYTES", 250)
+    monkeypatch.setattr(invoice_common, "BLOB_IN_USE_SECONDS", 60)
+    collection = mongomock.MongoClient().db.jobs
+    oldest = writeBlob(str(tmp_path / "ab" / "oldest.pdf"), 100, 4000)
+    older = writeBlob(str(tmp_path / "ab" / "older.pdf"), 100, 3000)
+    checkpointed = writeBlob(str(tmp_path / "cd" / "checkpointed.pdf"), 100, 5000)
+    recent = writeBlob(str(tmp_path / "cd" / "recent.pdf"), 100, 10)
+    collection.database[invoice_common.CHECKPOINT_COLLECTION].insert_one(
+        {"jobId": 1, "key": "checkpointed.pdf", "blob": checkpointed})
+
+    invoice_common.evictBlobCache(collection)
+
+    # Least recently used first, until the cache fits. Checkpointed and in use blobs are kept
+    assert not os.path.exists(oldest)
+    assert not os.path.exists(older)
+    assert os.path.exists(checkpointed)
+    assert os.path.exists(recent)
+
+
+PAYLOAD = bytes(range(256)) * 11 + b"%PDF-1.7 end"
+ENCODED = base64.b64encode(PAYLOAD).decode()
+WRAPPED = "\n".join(ENCODED[i:i + 76] for i in range(0, len(ENCODED), 76))
+PAGES = {
+    "/href-first": f'<html><body><a href="data:application/pdf;base64,{ENCODED}" id="downloadLink">Download</a>',
+    "/id-first": f"<html><body><a class='btn' id='downloadLink' href='data:application/pdf;base64,{ENCODED}'>x</a>",
+    "/whitespace": f'<a id="downloadLink" href="data:application/pdf;base64,\n  {WRAPPED}\n\t">Download</a>',
+    "/other-data-anchor": '<a href="data:image/png;base64,iVBORw0KGgo=" id="logo"><img></a>'
+                          f'<a href="data:application/pdf;base64,{ENCODED}" id="downloadLink">Download</a>',
+}
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGES[self.path].encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def pageServer():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def closingQuoteChunkSizes(page):
+    # Chunk sizes that put the quote closing the data URL first in a chunk, and last in the one before
+    quote = page.index(page[page.index("href=") + 5], page.index("base64,"))
+    return [size for size in range(2, 200) if quote % size in (0, size - 1)][:6] + [1, 64 * 1024]
+
+
+@pytest.mark.parametrize("path", ["/href-first", "/id-first", "/whitespace"])
+def testStreamDecodesTheDownloadLink(monkeypatch, tmp_path, pageServer, path):
+    for chunk_size in closingQuoteChunkSizes(PAGES[path]):
+        monkeypatch.setattr(invoice_common, "STREAM_CHUNK_SIZE", chunk_size)
+        prefix = str(tmp_path / f"{chunk_size}" / "blob")
+        os.makedirs(os.path.dirname(prefix))
+        file_path = invoice_common.stream_base64_to_file(pageServer + path, prefix)
+        assert file_path == prefix + ".pdf", chunk_size
+        with open(file_path, "rb") as blob:
+            assert blob.read() == PAYLOAD, chunk_size
+        assert os.listdir(os.path.dirname(prefix)) == ["blob.pdf"]
+
+
+def testEarlierDataAnchorFallsBackToThePageParser(monkeypatch, tmp_path, pageServer):
+    monkeypatch.setattr(invoice_common, "BLOB_CACHE_DIR", str(tmp_path))
+    url = pageServer + "/other-data-anchor"
+    prefix = str(tmp_path / "blob")
+    # The first data URL belongs to another anchor, streaming gives up and leaves no part file behind
+    assert invoice_common.stream_base64_to_file(url, prefix) is None
+    assert os.listdir(tmp_path) == []
+
+    blob_path = invoice_common.downloadInvoice(url)
+    with open(blob_path, "rb") as blob:
+        assert blob.read() == PAYLOAD
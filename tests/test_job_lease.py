@@ -0,0 +1,206 @@
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from multiprocessing.managers import BaseManager
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import job_lease  # noqa: E402
+from job_lease import JobLease, LeaseLost, claimJob, runLeasedJob, acquireHostSlot  # noqa: E402
+
+AUTHKEY = b"job-lease-test"
+
+
+class SharedJobs:
+    # One mongomock collection for every worker process, served by a manager in the test process. Each call
+    # holds the lock, like a single mongod applies one document update at a time
+    def __init__(self):
+        self.collection = mongomock.MongoClient().db.jobs
+        self.lock = threading.Lock()
+        self.deliveries = []
+
+    def insert_many(self, documents):
+        with self.lock:
+            self.collection.insert_many(documents)
+
+    def find(self, filter=None):
+        with self.lock:
+            return list(self.collection.find(filter))
+
+    def find_one_and_update(self, *args, **kwargs):
+        with self.lock:
+            return self.collection.find_one_and_update(*args, **kwargs)
+
+    def update_one(self, *args, **kwargs):
+        with self.lock:
+            result = self.collection.update_one(*args, **kwargs)
+            return SimpleNamespace(matched_count=result.matched_count)
+
+    def deliver(self, jobId, workerId):
+        # Stands in for the mail and the upload, the side effects that must happen once per job
+        with self.lock:
+            self.deliveries.append((jobId, workerId))
+
+    def getDeliveries(self):
+        with self.lock:
+            return list(self.deliveries)
+
+
+class JobsManager(BaseManager):
+    pass
+
+
+JobsManager.register("Jobs")
+
+
+def connectJobs():
+    manager = JobsManager(address=("127.0.0.1", int(os.environ["JOBS_MANAGER_PORT"])), authkey=AUTHKEY)
+    manager.connect()
+    return manager.Jobs()
+
+
+def deliverJob(jobs, job, lease):
+    time.sleep(0.05)
+    lease.transition("IN PROGRESS", "FINALIZING")
+    jobs.deliver(job["_id"], job["workerId"])
+    lease.update({"$set": {"status": "COMPLETED"}}, "FINALIZING")
+
+
+def processJob(job, jobtime):
+    # Runs in the spawned pool process of runWorker, the same way the report scripts run a job
+    jobs = connectJobs()
+    runLeasedJob(jobs, job, lambda job, lease: deliverJob(jobs, job, lease))
+
+
+def serveJobs(server):
+    try:
+        server.serve_forever()
+    except SystemExit:
+        # serve_forever exits this way once stop_event is set
+        pass
+
+
+def runWorkerProcess(concurrency):
+    job_lease.runWorker(connectJobs(), {}, processJob, concurrency)
+
+
+@pytest.fixture
+def sharedJobs(monkeypatch):
+    shared = SharedJobs()
+    JobsManager.register("Jobs", callable=lambda: shared)
+    server = JobsManager(address=("127.0.0.1", 0), authkey=AUTHKEY).get_server()
+    threading.Thread(target=serveJobs, args=(server,), daemon=True).start()
+    monkeypatch.setenv("JOBS_MANAGER_PORT", str(server.address[1]))
+    yield shared
+    server.stop_event.set()
+
+
+def testEveryJobRunsOnceAcrossWorkers(sharedJobs):
+    jobIds = list(range(40))
+    sharedJobs.insert_many([{"_id": jobId, "status": "PENDING", "createdBy": jobId} for jobId in jobIds])
+    # Left by a worker that died while finalizing, it is taken over and still delivered once
+    sharedJobs.insert_many([{"_id": 40, "status": "FINALIZING", "createdBy": 40, "workerId": "dead-worker",
+                             "attempts": 1, "leaseExpiresAt": datetime.now(timezone.utc) - timedelta(hours=1)}])
+    jobIds.append(40)
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=runWorkerProcess, args=(2,)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(120)
+        assert worker.exitcode == 0
+
+    delivered = sorted(jobId for jobId, _ in sharedJobs.getDeliveries())
+    assert delivered == jobIds
+    assert all(job["status"] == "COMPLETED" for job in sharedJobs.find())
+    assert [job["_id"] for job in sharedJobs.find({"attempts": {"$ne": 1}})] == [40]
+    # Every worker process took part, the jobs were not all claimed by the first one
+    assert len({workerId for _, workerId in sharedJobs.getDeliveries()}) > 1
+
+
+def testExpiredLeaseIsReclaimedAndFencesTheOldWorker(monkeypatch):
+    monkeypatch.setattr(job_lease, "LEASE_CLOCK_SKEW_SECONDS", 60)
+    jobs = mongomock.MongoClient().db.jobs
+    jobs.insert_one({"_id": 1, "status": "PENDING", "createdBy": 1})
+
+    job = claimJob(jobs, "worker-a", {})
+    lease = JobLease(jobs, job)
+    assert claimJob(jobs, "worker-b", {}) is None
+
+    # Expired, but not by more than the clock skew margin, another host may still see it as valid
+    jobs.update_one({"_id": 1}, {"$set": {"leaseExpiresAt": datetime.now(timezone.utc) - timedelta(seconds=30)}})
+    assert claimJob(jobs, "worker-b", {}) is None
+
+    jobs.update_one({"_id": 1}, {"$set": {"leaseExpiresAt": datetime.now(timezone.utc) - timedelta(seconds=90)}})
+    reclaimed = claimJob(jobs, "worker-b", {})
+    assert reclaimed["workerId"] == "worker-b"
+    assert reclaimed["attempts"] == 2
+
+    with pytest.raises(LeaseLost):
+        lease.transition("IN PROGRESS", "FINALIZING")
+    with pytest.raises(LeaseLost):
+        lease.check()
+    JobLease(jobs, reclaimed).transition("IN PROGRESS", "FINALIZING")
+    assert jobs.find_one({"_id": 1})["status"] == "FINALIZING"
+
+
+def testRunLeasedJobFailsJobsOutOfAttempts(monkeypatch):
+    monkeypatch.setattr(job_lease, "MAX_JOB_ATTEMPTS", 1)
+    jobs = mongomock.MongoClient().db.jobs
+    jobs.insert_many([{"_id": jobId, "status": "PENDING", "createdBy": jobId} for jobId in (1, 2)])
+    calls = []
+    runJob = lambda job, lease: calls.append(("run", job["_id"]))  # noqa: E731
+    failJob = lambda job: calls.append(("fail", job["_id"]))  # noqa: E731
+    finishJob = lambda: calls.append(("finish",))  # noqa: E731
+
+    runLeasedJob(jobs, claimJob(jobs, "worker-a", {"_id": 1}), runJob, failJob, finishJob)
+    jobs.update_one({"_id": 2}, {"$set": {"attempts": 1}})
+    runLeasedJob(jobs, claimJob(jobs, "worker-a", {"_id": 2}), runJob, failJob, finishJob)
+
+    assert calls == [("run", 1), ("finish",), ("fail", 2), ("finish",)]
+    assert jobs.find_one({"_id": 2})["status"] == "FAILED"
+
+    # A lost lease ends the job without an error, finishJob still runs
+    jobs.insert_one({"_id": 3, "status": "PENDING", "createdBy": 3})
+    job = claimJob(jobs, "worker-a", {"_id": 3})
+    jobs.update_one({"_id": 3}, {"$set": {"workerId": "worker-b"}})
+    runLeasedJob(jobs, job, lambda job, lease: lease.confirm(), failJob, finishJob)
+    assert calls[-1] == ("finish",)
+
+
+def testRenewLeaseNoticesTheLostJob(monkeypatch):
+    monkeypatch.setattr(job_lease, "JOB_LEASE_SECONDS", 0.3)
+    jobs = mongomock.MongoClient().db.jobs
+    jobs.insert_one({"_id": 1, "status": "PENDING", "createdBy": 1})
+    lease = JobLease(jobs, claimJob(jobs, "worker-a", {}))
+    lease.start()
+    try:
+        jobs.update_one({"_id": 1}, {"$set": {"workerId": "worker-b"}})
+        assert lease.lost.wait(2)
+        with pytest.raises(LeaseLost):
+            list(lease.checked(range(3)))
+    finally:
+        lease.stop()
+
+
+def testHostSlotsAreCapped(monkeypatch, tmp_path):
+    monkeypatch.setattr(job_lease, "HOST_LOCK_DIR", str(tmp_path))
+    monkeypatch.setattr(job_lease, "MAX_WORKERS_PER_HOST", 2)
+    first = acquireHostSlot("send-report")
+    second = acquireHostSlot("send-report")
+    assert first is not None and second is not None
+    assert acquireHostSlot("send-report") is None
+    # Other scripts have their own slots
+    other = acquireHostSlot("invoice-report")
+    assert other is not None
+    first.close()
+    third = acquireHostSlot("send-report")
+    assert third is not None
+    for slot in (second, other, third):
+        slot.close()
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pg_query import getTableIdentifier, executePrepared, prepared_statements  # noqa: E402
+
+
+def testTableNamesAreFoldedUnlessQuoted():
+    assert getTableIdentifier("Invoices").strings == ("invoices",)
+    assert getTableIdentifier("Recon.Invoices").strings == ("recon", "invoices")
+    assert getTableIdentifier('recon."Invoices 2024"').strings == ("recon", "Invoices 2024")
+    assert getTableIdentifier('"a""b"').strings == ('a"b',)
+
+
+@pytest.fixture
+def pgconn(tmp_path):
+    pgserver = pytest.importorskip("pgserver")
+    conn = psycopg2.connect(pgserver.get_server(str(tmp_path / "pgdata"), cleanup_mode="stop").get_uri())
+    yield conn
+    conn.close()
+
+
+def testPreparedLookupTakesUuidArrays(pgconn):
+    with pgconn.cursor() as cursor:
+        cursor.execute("CREATE TABLE workspaces (id uuid PRIMARY KEY, name text)")
+        cursor.execute("INSERT INTO workspaces VALUES ('7b0c6c1e-1111-4c1e-9a58-111111111111', 'Acme WS')")
+        pgconn.commit()
+        query = "SELECT name FROM workspaces WHERE id = ANY($1::uuid[])"
+        for _ in range(2):
+            executePrepared(cursor, "workspace_names", query, (["7b0c6c1e-1111-4c1e-9a58-111111111111"],),
+                            ("text[]",))
+            assert cursor.fetchall() == [("Acme WS",)]
+        # Rolled back jobs keep the statement, the next job on the connection only executes it
+        pgconn.rollback()
+        executePrepared(cursor, "workspace_names", query, ([],), ("text[]",))
+        assert cursor.fetchall() == []
+    assert prepared_statements[pgconn] == {"workspace_names"}
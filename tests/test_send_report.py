@@ -0,0 +1,153 @@
+import datetime
+import os
+import re
+import sys
+import zipfile
+from decimal import Decimal
+
+import openpyxl
+import pandas as pd
+import psycopg2
+import pyarrow.parquet as pq
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from script_loader import loadScript  # noqa: E402
+
+send_report = loadScript("send-report.py")
+
+
+def testParquetSchemaComesFromTheResultColumns(tmp_path):
+    result_types = {"Invoice Date": send_report.DATE_TYPE_OID, "Amount": 1700,
+                    "Booked At": send_report.TIMESTAMPTZ_TYPE_OID, "Vendor": 25, "Count": 23}
+    tz = datetime.timezone(datetime.timedelta(hours=5, minutes=30))
+    # The first batch has no dates and only small amounts, the second one has both
+    first = pd.DataFrame({"Invoice Date": [None, None], "Amount": [Decimal("1.5"), Decimal("2.25")],
+                          "Booked At": [datetime.datetime(2024, 1, 2, 10, tzinfo=tz), None],
+                          "Vendor": pd.Categorical(["Acme", "Acme"]), "Count": [1, None]})
+    second = pd.DataFrame({"Invoice Date": [datetime.date(2024, 3, 31), None],
+                           "Amount": [Decimal("123456789.123456"), None],
+                           "Booked At": [None, datetime.datetime(2024, 5, 6, 7, tzinfo=tz)],
+                           "Vendor": pd.Categorical(["Globex", None]), "Count": [None, 7]})
+    filename = str(tmp_path / "report.parquet")
+
+    total_records = send_report.parquetWriter(filename, "Recon", [], "user", iter([first, second]), result_types)
+
+    assert total_records == 4
+    table = pq.read_table(filename)
+    assert [str(field.type) for field in table.schema] == ["date32[day]", "double", "timestamp[us, tz=UTC]",
+                                                           "string", "int64"]
+    assert table.column("Invoice Date").to_pylist() == [None, None, datetime.date(2024, 3, 31), None]
+    assert table.column("Amount").to_pylist() == [1.5, 2.25, 123456789.123456, None]
+    assert table.column("Vendor").to_pylist() == ["Acme", "Acme", "Globex", None]
+    assert table.column("Count").to_pylist() == [1, None, None, 7]
+    assert table.column("Booked At").to_pylist()[3] == datetime.datetime(2024, 5, 6, 1, 30,
+                                                                         tzinfo=datetime.timezone.utc)
+
+
+def testFailedCopyProbeClosesItsConnection(monkeypatch, tmp_path):
+    pgserver = pytest.importorskip("pgserver")
+    uri = pgserver.get_server(str(tmp_path / "pgdata"), cleanup_mode="stop").get_uri()
+    connections = []
+
+    def connectPostgres():
+        connections.append(psycopg2.connect(uri))
+        return connections[-1]
+
+    monkeypatch.setattr(send_report, "connectPostgres", connectPostgres)
+    with pytest.raises(psycopg2.errors.UndefinedColumn):
+        list(send_report.fetchCopyBatches("SELECT missing FROM pg_class", None, {}))
+    assert connections[0].closed
+
+    # An empty result yields no batch and closes the connection as well
+    assert list(send_report.fetchCopyBatches("SELECT relname FROM pg_class WHERE false", None, {})) == []
+    assert connections[1].closed
+
+
+def renderWorkbook(monkeypatch, filename, sheet_workers):
+    monkeypatch.setattr(send_report, "SHEET_WORKERS", sheet_workers)
+    monkeypatch.setattr(send_report, "SHEET_ROWS", 3)
+    monkeypatch.setattr(send_report, "getCreatedBy", lambda createdbyId: "Report User")
+    batches = [
+        pd.DataFrame({"Vendor": ["Acme", "Globex", "Acme", "Initech"],
+                      "Invoice": ["https://files.example/1", None, "https://files.example/3",
+                                  "https://files.example/4"],
+                      "Invoice Date": ["13/01/2024", "02/03/2024", None, "05/06/2024 10:30"],
+                      "Amount": [1.5, 2.0, None, 4.25]}),
+        pd.DataFrame({"Vendor": ["Globex", None, None, None],
+                      "Invoice": ["https://files.example/5", None, None, None],
+                      "Invoice Date": ["07/08/2024", None, None, None],
+                      "Amount": [5.0, 6.0, 7.0, 8.5]}),
+    ]
+    header_details = [["Amount", "NUMBER", "SUM", 34.25, "", "", "NO", "NO"]]
+    total_records = send_report.xlsxWriter(filename, "Recon", header_details, ["Invoice"], ["Invoice Date"], "user",
+                                           iter(batches))
+    assert total_records == 8
+    return openpyxl.load_workbook(filename)
+
+
+def readSheet(ws):
+    return [[(cell.value, cell.hyperlink.target if cell.hyperlink else None, cell.number_format, cell.font.b)
+             for cell in row] for row in ws.iter_rows()]
+
+
+INLINE_STRING_CELL = re.compile(r'<c ([^>]*)t="inlineStr"><is><t[^>]*>([^<]*)</t></is></c>')
+
+
+def useSharedStrings(path):
+    # openpyxl 3.1 writes inline strings, older versions write shared strings. The workbook and its parts are
+    # rewritten to shared strings so assembleWorkbook has to renumber them
+    with zipfile.ZipFile(path) as xlsx_zip:
+        items = {name: xlsx_zip.read(name) for name in xlsx_zip.namelist()}
+    strings = []
+
+    def toSharedString(match):
+        strings.append(match.group(2))
+        return f'<c {match.group(1)}t="s"><v>{len(strings) - 1}</v></c>'
+
+    for name in items:
+        if name.startswith("xl/worksheets/sheet"):
+            items[name] = INLINE_STRING_CELL.sub(toSharedString, items[name].decode()).encode()
+    items["xl/sharedStrings.xml"] = (
+        '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        + "".join(f"<si><t>{string}</t></si>" for string in strings) + "</sst>").encode()
+    items["[Content_Types].xml"] = items["[Content_Types].xml"].replace(
+        b"</Types>", b'<Override PartName="/xl/sharedStrings.xml" ContentType="application/'
+                     b'vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/></Types>')
+    items["xl/_rels/workbook.xml.rels"] = items["xl/_rels/workbook.xml.rels"].replace(
+        b"</Relationships>", b'<Relationship Id="rIdStrings" Target="sharedStrings.xml" Type="http://schemas.'
+                             b'openxmlformats.org/officeDocument/2006/relationships/sharedStrings"/></Relationships>')
+    with zipfile.ZipFile(path, "w") as xlsx_zip:
+        for name, data in items.items():
+            xlsx_zip.writestr(name, data)
+
+
+def testSheetWorkersRenderTheSameWorkbook(monkeypatch, tmp_path):
+    # Spawned sheet workers import the script by its module name, this shim makes that name importable
+    (tmp_path / "send_report.py").write_text(
+        "from unittest import mock\n"
+        f"with mock.patch('psycopg2.connect'), mock.patch('pymongo.MongoClient'):\n"
+        f"    exec(compile(open({send_report.__file__!r}).read(), {send_report.__file__!r}, 'exec'))\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    sequential = renderWorkbook(monkeypatch, str(tmp_path / "sequential.xlsx"), 1)
+    parallel = renderWorkbook(monkeypatch, str(tmp_path / "parallel.xlsx"), 2)
+    assembleWorkbook = send_report.assembleWorkbook
+
+    def assembleSharedStrings(filename, part_paths):
+        # The last part keeps its inline strings and has no sharedStrings.xml, like a chunk without strings
+        for path in [filename] + part_paths[:-1]:
+            useSharedStrings(path)
+        assembleWorkbook(filename, part_paths)
+
+    monkeypatch.setattr(send_report, "assembleWorkbook", assembleSharedStrings)
+    shared = renderWorkbook(monkeypatch, str(tmp_path / "shared.xlsx"), 2)
+    assert "xl/sharedStrings.xml" in zipfile.ZipFile(str(tmp_path / "shared.xlsx")).namelist()
+
+    assert sequential.sheetnames == parallel.sheetnames == shared.sheetnames == ["Cover", "Sheet1", "Sheet2", "Sheet3"]
+    for name in sequential.sheetnames:
+        assert readSheet(parallel[name]) == readSheet(sequential[name]), name
+        assert readSheet(shared[name]) == readSheet(sequential[name]), name
+    # The last chunk has no strings besides its header, the dates of every chunk use the first chunk's d/m order
+    assert [row[0] for row in readSheet(sequential["Sheet3"])[1:]] == [(None, None, "General", False)] * 2
+    assert readSheet(sequential["Sheet1"])[2][2][0] == datetime.datetime(2024, 3, 2)
+    assert readSheet(sequential["Sheet2"])[1][1][1] == "https://files.example/4"